@@ -0,0 +1,512 @@
+"""Offline benchmarks for the bot's hot paths.
+
+Drives load_users, create_team_channels, create_invites, send_invites,
+on_member_join (team by team and interleaved), claim code redemption and teardown from main.py against a simulated guild whose REST layer models
+Discord's per-route rate limits and latency, and a local SMTP sink for mail.
+Nothing talks to Discord or a real mailbox.
+
+    python benchmark.py                       # 100, 1k and 10k participants
+    python benchmark.py --sizes 500 --time-scale 0.01
+
+All simulated durations (latency, rate-limit windows, join retry delays,
+invite pacing) are multiplied by --time-scale so large runs finish on a
+laptop; "sim s" columns convert measured time back to simulated seconds.
+"""
+import argparse
+import asyncio
+import contextlib
+import copy
+import itertools
+import os
+import socketserver
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+
+import discord
+
+# Approximate per-route buckets as (requests, window seconds), keyed per guild or channel.
+# Discord doesn't publish exact numbers, tune these to what you observe.
+ROUTE_LIMITS = {
+    'create_role': (10, 10),
+    'edit_role': (10, 10),
+    'edit_role_positions': (10, 10),
+    'create_channel': (10, 10),
+    'create_invite': (5, 5),
+    'list_invites': (5, 5),
+    'delete_invite': (5, 5),
+    'delete_channel': (5, 5),
+    'delete_role': (10, 10),
+    'add_role': (10, 10),
+    'remove_role': (10, 10),
+    'send_message': (5, 5),
+    'edit_message': (5, 5),
+}
+API_LATENCY = 0.08  # Seconds per simulated REST call
+TEAM_SIZE = 4
+TEAM_ARRIVAL_GAP = 4.5  # Seconds between two teams clicking their emails in the team-by-team join scenario
+INTERLEAVED_JOIN_GAP = 1.5  # Seconds between two joins, each from a different team, in the interleaved scenario
+
+# ----------------------------
+# SIMULATED DISCORD
+# ----------------------------
+class FakeHTTP:
+    """Per-route sliding-window buckets, waits instead of returning 429s like discord.py does"""
+
+    def __init__(self, scale):
+        self.scale = scale
+        self.history = {}
+        self.calls = Counter()
+        self.waits = Counter()
+        self.wait_time = 0.0
+
+    async def request(self, route, major):
+        limit, window = ROUTE_LIMITS.get(route, (50, 1))
+        window *= self.scale
+        history = self.history.setdefault((route, major), deque())
+        while True:
+            now = time.monotonic()
+            while history and now - history[0] >= window:
+                history.popleft()
+            if len(history) < limit:
+                break
+            delay = window - (now - history[0])
+            self.waits[route] += 1
+            self.wait_time += delay
+            await asyncio.sleep(delay)
+        history.append(now)
+        self.calls[route] += 1
+        await asyncio.sleep(API_LATENCY * self.scale)
+
+_ids = itertools.count(10_000)
+
+class FakeRole:
+    def __init__(self, guild, name, position):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.position = position
+        self.mention = f"<@&{self.id}>"
+        self.managed = False
+
+    async def edit(self, position=None, **kwargs):
+        await self.guild.http.request('edit_role', self.guild.id)
+        if position is not None:
+            self.position = position
+
+    async def delete(self, reason=None):
+        await self.guild.http.request('delete_role', self.guild.id)
+        self.guild.roles.remove(self)
+
+class FakeMessage:
+    def __init__(self, channel, content=None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        await self.channel.guild.http.request('edit_message', self.id)
+        self.content = content
+
+    async def delete(self):
+        await self.channel.guild.http.request('send_message', self.channel.id)
+
+class FakeChannel:
+    def __init__(self, guild, name, channel_type, category=None):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.type = channel_type
+        self.category = category
+        self.channels = []  # Only used by categories
+
+    async def send(self, content=None, **kwargs):
+        await self.guild.http.request('send_message', self.id)
+        return FakeMessage(self, content)
+
+    async def create_invite(self, max_uses=0, reason=None, **kwargs):
+        await self.guild.http.request('create_invite', self.id)
+        invite = FakeInvite(self.guild, max_uses)
+        self.guild.live_invites[invite.code] = invite
+        return invite
+
+    async def delete(self, reason=None):
+        await self.guild.http.request('delete_channel', self.id)
+        self.guild.channels.remove(self)
+        if self.category:
+            self.category.channels.remove(self)
+
+class FakeInvite:
+    def __init__(self, guild, max_uses):
+        self.guild = guild
+        self.code = self.id = f"sim{next(_ids)}"
+        self.inviter = None  # The bot, whose user is None while offline
+        self.url = f"https://discord.gg/{self.code}"
+        self.uses = 0
+        self.max_uses = max_uses
+
+    def use(self):
+        self.uses += 1
+        if self.max_uses and self.uses >= self.max_uses:
+            del self.guild.live_invites[self.code]  # Discord deletes exhausted invites
+
+    async def delete(self, reason=None):
+        await self.guild.http.request('delete_invite', self.guild.id)
+        self.guild.live_invites.pop(self.code, None)
+
+class FakeMember:
+    def __init__(self, guild, name):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.mention = f"<@{self.id}>"
+        self.roles = []
+        self.joined_at = time.monotonic()
+        self.role_at = None
+
+    async def add_roles(self, *roles, **kwargs):
+        await self.guild.http.request('add_role', self.guild.id)
+        self.roles.extend(roles)
+        self.role_at = time.monotonic()
+
+    async def remove_roles(self, *roles, **kwargs):
+        await self.guild.http.request('remove_role', self.guild.id)
+        self.roles = [role for role in self.roles if role not in roles]
+
+class Permissions:
+    manage_guild = manage_roles = True
+    view_audit_log = False
+
+class FakeGuild:
+    def __init__(self, http):
+        self.id = next(_ids)
+        self.name = "Benchmark Guild"
+        self.http = http
+        self.roles = []
+        self.channels = []
+        self.live_invites = {}
+        self.members = {}
+        self.default_role = self._add_role("@everyone", 0)
+        self._add_role("Admin", 1)
+        bot_role = self._add_role("Bot", 10_000)
+        self.me = FakeMember(self, "bot")
+        self.me.top_role = bot_role
+        self.me.guild_permissions = Permissions()
+
+    def _add_role(self, name, position):
+        role = FakeRole(self, name, position)
+        self.roles.append(role)
+        return role
+
+    def _add_channel(self, name, channel_type, category=None):
+        channel = FakeChannel(self, name, channel_type, category)
+        self.channels.append(channel)
+        if category:
+            category.channels.append(channel)
+        return channel
+
+    @property
+    def text_channels(self):
+        return [c for c in self.channels if c.type == discord.ChannelType.text]
+
+    @property
+    def voice_channels(self):
+        return [c for c in self.channels if c.type == discord.ChannelType.voice]
+
+    @property
+    def categories(self):
+        return [c for c in self.channels if c.type == discord.ChannelType.category]
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+    async def create_role(self, name, **kwargs):
+        await self.http.request('create_role', self.id)
+        return self._add_role(name, 1)
+
+    async def edit_role_positions(self, positions, **kwargs):
+        await self.http.request('edit_role_positions', self.id)
+        for role, position in positions.items():
+            role.position = position
+
+    async def create_category(self, name, **kwargs):
+        await self.http.request('create_channel', self.id)
+        return self._add_channel(name, discord.ChannelType.category)
+
+    async def create_text_channel(self, name, category=None, **kwargs):
+        await self.http.request('create_channel', self.id)
+        return self._add_channel(name.replace(" ", "-").lower(), discord.ChannelType.text, category)
+
+    async def create_voice_channel(self, name, category=None, **kwargs):
+        await self.http.request('create_channel', self.id)
+        return self._add_channel(name, discord.ChannelType.voice, category)
+
+    async def invites(self):
+        # Discord builds the list before the response arrives, and later uses don't change it
+        snapshot = [copy.copy(invite) for invite in self.live_invites.values()]
+        await self.http.request('list_invites', self.id)
+        return snapshot
+
+class FakeAttachment:
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.data = data
+
+    async def read(self):
+        return self.data
+
+class FakeContext:
+    def __init__(self, guild, attachment=None):
+        self.guild = guild
+        self.channel = guild._add_channel("general", discord.ChannelType.text)
+        self.author = guild.me
+        self.message = type("Message", (), {'attachments': [attachment] if attachment else []})()
+
+    async def defer(self):
+        pass
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+# ----------------------------
+# LOCAL SMTP SINK
+# ----------------------------
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: EHLO, AUTH, MAIL/RCPT/DATA, RSET, QUIT"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.reply("220 sink ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith("EHLO"):
+                self.wfile.write(b"250-sink\r\n250 AUTH PLAIN LOGIN\r\n")
+            elif command.startswith("AUTH"):
+                self.reply("235 2.7.0 Authentication successful")
+            elif command.startswith("DATA"):
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                self.server.delivered += 1
+                self.reply("250 OK")
+            elif command.startswith("QUIT"):
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SMTPSinkHandler)
+        self.delivered = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+# ----------------------------
+# SCENARIOS
+# ----------------------------
+def roster_csv(participants):
+    lines = ["firstname,lastname,email,team"]
+    lines += [
+        f"First{i},Last{i},user{i}@example.com,Team {i // TEAM_SIZE:05d}"
+        for i in range(participants)
+    ]
+    return "\n".join(lines).encode()
+
+async def wait_for_joins(main, guild_id, members, timeout):
+    """Wait until every join has an outcome (assigned, ambiguous or unmatched)"""
+    join_started = main.guild_state(guild_id).join_started
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if main.bot.join_queues[guild_id].empty() and not any(m.id in join_started for m in members):
+            return
+        await asyncio.sleep(0.01)
+
+def join_outcomes(main):
+    return {label: value for (name, label), value in main.bot.metrics.counters.items() if name == 'joins_total'}
+
+def describe_join_outcomes(main, before):
+    outcomes = join_outcomes(main)
+    return ", ".join(f"{outcomes.get(outcome, 0) - before.get(outcome, 0)} {outcome}" for outcome in ('ambiguous', 'unmatched'))
+
+def describe_join_latency(members, scale):
+    latencies = [(m.role_at - m.joined_at) / scale for m in members if m.role_at]
+    if not latencies:
+        return "no roles assigned"
+    return (
+        f"{len(latencies)}/{len(members)} assigned, join-to-role p50 "
+        f"{statistics.median(latencies):.2f}s p95 {sorted(latencies)[int(len(latencies) * 0.95) - 1]:.2f}s (sim)"
+    )
+
+async def run_size(main, participants, scale):
+    http = FakeHTTP(scale)
+    guild = FakeGuild(http)
+    ctx = FakeContext(guild, FakeAttachment("roster.csv", roster_csv(participants)))
+    results = []
+
+    async def measure(name, coro_fn):
+        calls_before, waits_before, wait_time_before = sum(http.calls.values()), sum(http.waits.values()), http.wait_time
+        tracemalloc.start()
+        started = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            note = await coro_fn()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append((
+            name, elapsed, elapsed / scale, sum(http.calls.values()) - calls_before,
+            sum(http.waits.values()) - waits_before, (http.wait_time - wait_time_before) / scale,
+            peak / 1e6, note or ""
+        ))
+
+    async def load():
+        job = await main.load_users.callback(ctx)
+        await job.wait()
+        return f"{len(main.guild_state(guild.id).roster.teams)} teams"
+
+    async def team_channels():
+        teams = list(main.guild_state(guild.id).roster)[:50]
+        for team in teams:
+            await main.create_team_channels(guild, team)
+        return f"{len(teams)} existing teams"
+
+    async def invites():
+        job = await main.create_invites.callback(ctx)
+        await job.wait()
+        return f"{len(guild.live_invites)} live invites"
+
+    async def emails():
+        # SMTP runs in real time against the sink, so read wall time here rather than sim time
+        before, started = sink.delivered, time.perf_counter()
+        job = await main.send_invites.callback(ctx)
+        await job.wait()
+        delivered = sink.delivered - before
+        return f"{delivered} delivered, {delivered / (time.perf_counter() - started):.0f} emails/s (wall)"
+
+    async def join(team, user):
+        url = main.find_member_invite(guild.id, team, user.email)
+        guild.live_invites[main.invite_code(url)].use()
+        member = FakeMember(guild, user.email)
+        guild.members[member.id] = member
+        await main.on_member_join(member)
+        return member
+
+    async def settle_joins(members):
+        await wait_for_joins(main, guild.id, members, timeout=main.JOIN_MATCH_TIMEOUT * 2 + 5)
+        return describe_join_latency(members, scale)
+
+    async def joins():
+        members = []
+        before = join_outcomes(main)
+        for team, users in main.guild_state(guild.id).roster.items():
+            # A team's members click their emails together, teams arrive a few seconds apart
+            for user in users:
+                members.append(await join(team, user))
+            await asyncio.sleep(TEAM_ARRIVAL_GAP * scale)
+        return f"{await settle_joins(members)}, {describe_join_outcomes(main, before)}"
+
+    async def reinvite():
+        # Everyone left again, mint fresh invites outside the measurements
+        main.guild_state(guild.id).joined_members = {}
+        job = await main.create_invites.callback(ctx)
+        await job.wait()
+
+    async def interleaved_joins():
+        members = []
+        before = join_outcomes(main)
+        teams = [[(team, user) for user in users] for team, users in main.guild_state(guild.id).roster.items()]
+        # Every team's first member, then every team's second member..., one join at a time
+        for team, user in (row for rows in itertools.zip_longest(*teams) for row in rows if row):
+            members.append(await join(team, user))
+            await asyncio.sleep(INTERLEAVED_JOIN_GAP * scale)
+        return f"{await settle_joins(members)}, {describe_join_outcomes(main, before)}"
+
+    async def claims():
+        # Same arrival pattern, but every member redeems a claim code instead of being matched to an invite
+        main.guild_state(guild.id).joined_members = {}
+        main.issue_claim_codes(guild.id, [(team, user) for team, users in main.guild_state(guild.id).roster.items() for user in users])
+        members, claiming = [], []
+        for team, users in main.guild_state(guild.id).roster.items():
+            for user in users:
+                member = FakeMember(guild, user.email)
+                guild.members[member.id] = member
+                members.append(member)
+                code = main.guild_state(guild.id).member_claims[main.invite_key(guild.id, team, user.email)]
+                claiming.append(asyncio.create_task(main.claim_team(member, code)))
+            await asyncio.sleep(TEAM_ARRIVAL_GAP * scale)
+        await asyncio.gather(*claiming)
+        return describe_join_latency(members, scale)
+
+    async def teardown():
+        job = await main.teardown.callback(ctx, confirm=True)
+        await job.wait()
+        left = sum(1 for channel in guild.channels if main.team_category_number(getattr(channel.category, 'name', '')) is not None)
+        return f"{job.progress.content}, {left} team channels left"
+
+    await measure("load_users", load)
+    await measure("create_team_channels", team_channels)
+    await measure("create_invites", invites)
+    await measure("send_invites", emails)
+    await measure("on_member_join", joins)
+    await reinvite()
+    await measure("interleaved_joins", interleaved_joins)
+    await measure("claim_codes", claims)
+    await measure("teardown", teardown)
+    return results
+
+def print_results(participants, results):
+    print(f"\n== {participants} participants ==")
+    print(f"{'scenario':<22}{'wall s':>9}{'sim s':>10}{'API calls':>11}{'RL waits':>10}{'RL sim s':>10}{'peak MB':>9}  notes")
+    for name, wall, simulated, calls, waits, wait_time, peak, note in results:
+        print(f"{name:<22}{wall:>9.2f}{simulated:>10.1f}{calls:>11}{waits:>10}{wait_time:>10.1f}{peak:>9.1f}  {note}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help="participant counts to run")
+    parser.add_argument('--time-scale', type=float, default=0.001, help="multiplier for every simulated duration")
+    args = parser.parse_args()
+
+    global sink
+    sink = SMTPSink()
+    scale = args.time_scale
+    os.environ.update({
+        'DISCORD_TOKEN': 'benchmark',
+        'STATE_DB': ':memory:',
+        'EMAIL_ADDRESS': 'bench@example.com',
+        'EMAIL_PASSWORD': 'benchmark',
+        'SMTP_SERVER': '127.0.0.1',
+        'SMTP_PORT': str(sink.server_address[1]),
+        'SMTP_STARTTLS': 'false',
+        'INVITE_RATE': str(1 / scale),
+        'JOIN_RETRY_DELAY': str(2 * scale),
+        'JOIN_MATCH_TIMEOUT': str(30 * scale),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    devnull = open(os.devnull, 'w')  # Stays open, main's log writer thread binds stdout at import
+    with contextlib.redirect_stdout(devnull):
+        import main as bot_module
+    import pandas  # main only imports it on the first /load, keep that out of the timings
+
+    for participants in args.sizes:
+        # Fresh bot state for every size
+        bot_module.bot.guild_states = {}
+        # Queues, workers and locks belong to the previous run's event loop
+        bot_module.bot.join_queues, bot_module.bot.join_workers = {}, {}
+        bot_module.bot.provision_locks, bot_module.bot.guild_indexes, bot_module.bot.category_slots = {}, {}, {}
+        bot_module.bot.job_queues, bot_module.bot.job_workers, bot_module.bot.snapshot_locks = {}, {}, {}
+        bot_module.bot.mailer.slots = asyncio.Semaphore(bot_module.bot.mailer.pool_size)
+        results = asyncio.run(run_size(bot_module, participants, scale))
+        print_results(participants, results)
+
+if __name__ == "__main__":
+    main()
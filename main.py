@@ -1,110 +1,1075 @@
 import discord
-import pandas as pd
-import smtplib
+import aiohttp
 import asyncio
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from discord.ext import commands
+import queue
+import time
+import array
+import bisect
+import heapq
+import collections
+import atexit
+import contextlib
+import contextvars
+import functools
+import hashlib
+import logging
+import logging.handlers
+import random
+import itertools
+import secrets
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal
+from discord.ext import commands, tasks
 import os
+import io
+import csv
+import json
+import sqlite3
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
+
+# ----------------------------
+# LOGGING
+# ----------------------------
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()  # DEBUG adds a line per role, channel, invite and email
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()  # 'text' or 'json' (one object per line, for log shippers)
+
+log_context = contextvars.ContextVar('log_context', default={})  # Guild/job of the task that's logging
+
+class LogFormatter(logging.Formatter):
+    """One line per record as text or JSON, tagged with its guild and job"""
+
+    def __init__(self, as_json=False):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        message = record.getMessage()
+        if record.exc_info:
+            message += "\n" + self.formatException(record.exc_info)
+        context = {key: value for key, value in record.context.items() if value is not None}
+        if self.as_json:
+            return json.dumps(
+                {'time': self.formatTime(record), 'level': record.levelname, 'message': message, **context},
+                ensure_ascii=False,
+            )
+        tags = "".join(f"[{key} {value}] " for key, value in context.items())
+        return f"{self.formatTime(record)} {record.levelname:<7} {tags}{message}"
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    """Captures the caller's context and hands the record to the writer thread unformatted"""
+
+    def prepare(self, record):
+        record.context = log_context.get()  # Must be read on the caller's task, not the writer thread
+        return record
+
+# Per-item lines are debug with %-style args, so at INFO they cost a level check and nothing else.
+# Everything that passes is formatted and written on a background thread, never on the event loop.
+log = logging.getLogger('team_manager')
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+_log_queue = queue.SimpleQueue()
+log.addHandler(QueueLogHandler(_log_queue))
+_log_writer = logging.StreamHandler(sys.stdout)
+_log_writer.setFormatter(LogFormatter(as_json=LOG_FORMAT == 'json'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_writer)
+_log_listener.start()
+atexit.register(_log_listener.stop)  # Drains what's still queued
+
 if not os.getenv('DISCORD_TOKEN'):
     raise ValueError("Missing DISCORD_TOKEN in .env file")
 if not os.getenv('EMAIL_ADDRESS'):
-    print("Warning: Email functionality will be disabled")
+    log.warning("⚠️ Email functionality will be disabled")
 
 # Initialize bot with necessary intents
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
-bot = commands.Bot(command_prefix='/', intents=intents)
+SHARDING = os.getenv('SHARDING', 'off').lower()  # 'off', 'auto' (Discord's recommended count) or a fixed shard count
+if SHARDING == 'off':
+    bot = commands.Bot(command_prefix='/', intents=intents)
+else:
+    # Each shard gets its own gateway connection, state is already partitioned per guild
+    bot = commands.AutoShardedBot(
+        command_prefix='/', intents=intents, shard_count=None if SHARDING == 'auto' else int(SHARDING)
+    )
+
+# ----------------------------
+# METRICS
+# ----------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)  # Seconds
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))  # Local Prometheus text endpoint, 0 disables it
+THROUGHPUT_WINDOW = 60  # Seconds of history behind the /stats throughput figures
+
+class Histogram:
+    """Latency histogram over fixed bucket bounds"""
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # Last slot is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+class Metrics:
+    """In-process counters, latency histograms and throughput windows keyed by (name, label)"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = {}  # {(name, label): value}
+        self.histograms = {}  # {(name, label): Histogram}
+        self.events = {}  # {name: deque of monotonic timestamps}
+
+    def inc(self, name, label='', value=1):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, label, seconds):
+        key = (name, label)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(seconds)
+
+    def mark(self, name):
+        """Record one occurrence for throughput reporting"""
+        if name not in self.events:
+            self.events[name] = collections.deque(maxlen=100000)
+        self.events[name].append(time.monotonic())
+
+    def rate(self, name, window=THROUGHPUT_WINDOW):
+        """Occurrences per second over the last `window` seconds"""
+        stamps = self.events.get(name, ())
+        since = time.monotonic() - window
+        recent = sum(1 for stamp in reversed(stamps) if stamp >= since)
+        return recent / min(window, max(time.monotonic() - self.started, 1))
+
+    @contextlib.contextmanager
+    def timer(self, name, label=''):
+        """Time a block into a histogram, counting it as an error if it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(f"{name}_errors_total", label)
+            raise
+        finally:
+            self.observe(name, label, time.perf_counter() - started)
+
+    def total(self, name):
+        """Sum of a counter across all its labels"""
+        return sum(value for (counter, _), value in self.counters.items() if counter == name)
+
+    def rows(self):
+        """(metric, label, count, avg, p50, p95, max) for every histogram"""
+        return [
+            (name, label, h.count, h.total / h.count, h.quantile(0.5), h.quantile(0.95), h.max)
+            for (name, label), h in sorted(self.histograms.items()) if h.count
+        ]
+
+    def render_prometheus(self):
+        """Prometheus text exposition of everything recorded so far"""
+        def labels(label, extra=''):
+            pairs = [f'label="{label}"'] if label else []
+            if extra:
+                pairs.append(extra)
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = [f"teambot_uptime_seconds {time.monotonic() - self.started:.3f}"]
+        for (name, label), value in sorted(self.counters.items()):
+            lines.append(f"teambot_{name}{labels(label)} {value:g}")
+        for (name, label), h in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), h.counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound:g}"'
+                lines.append(f"teambot_{name}_bucket{labels(label, le)} {cumulative}")
+            lines.append(f"teambot_{name}_sum{labels(label)} {h.total:.6f}")
+            lines.append(f"teambot_{name}_count{labels(label)} {h.count}")
+        for name in sorted(self.events):
+            lines.append(f"teambot_{name}_per_second {self.rate(name):.3f}")
+        return "\n".join(lines) + "\n"
+
+bot.metrics = Metrics()
+
+def metered_event(coro):
+    """Register an event handler with its latency recorded under event_seconds"""
+    @functools.wraps(coro)
+    async def handler(*args, **kwargs):
+        with bot.metrics.timer('event_seconds', coro.__name__):
+            return await coro(*args, **kwargs)
+    return bot.event(handler)
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.metrics_started = time.perf_counter()
+    log_context.set({'guild': ctx.guild.id if ctx.guild else None})
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    record_command(ctx)  # Failures are counted by the error listener
+
+@bot.listen('on_command_error')
+async def count_command_error(ctx, error):
+    record_command(ctx, failed=True)
+    if ctx.command and not ctx.command.has_error_handler():
+        # Registering a listener silences discord.py's default traceback, so keep it
+        log.error(f"❌ Command {ctx.command.qualified_name} failed", exc_info=(type(error), error, error.__traceback__))
+
+def record_command(ctx, failed=False):
+    name = ctx.command.qualified_name if ctx.command else 'unknown'
+    if failed:
+        bot.metrics.inc('command_errors_total', name)
+    started = getattr(ctx, 'metrics_started', None)
+    if started is not None:
+        del ctx.metrics_started  # A failed prefix command reaches both the after hook and the error listener
+        bot.metrics.observe('command_seconds', name, time.perf_counter() - started)
+
+RATELIMIT_WAIT_FLOOR = 0.01  # Seconds; less than this outside the round-trips is body parsing, not a wait
+
+_discord_request = bot.http.request
+_current_route = contextvars.ContextVar('current_route', default='unknown')
+_round_trip_seconds = contextvars.ContextVar('round_trip_seconds', default=None)  # [seconds] of the request being metered
+
+async def _round_trip_started(session, trace, params):
+    trace.started = time.perf_counter()
+
+async def _round_trip_ended(session, trace, params):
+    spent = _round_trip_seconds.get()
+    if spent is not None:
+        spent[0] += time.perf_counter() - trace.started
+
+# aiohttp runs these hooks in the calling task, so they see the context of the request being metered
+_http_trace = aiohttp.TraceConfig()
+_http_trace.on_request_start.append(_round_trip_started)
+_http_trace.on_request_end.append(_round_trip_ended)
+_http_trace.on_request_exception.append(_round_trip_ended)
+bot.http.http_trace = _http_trace  # Picked up when the session is created at login
+
+async def metered_request(route, **kwargs):
+    """HTTPClient.request with per-route latency, call and error counts.
+
+    Whatever the call spent outside its HTTP round-trips was spent in
+    discord.py's rate limiting: queued on the route bucket, sleeping before
+    an exhausted bucket resets, or waiting out a 429.
+    """
+    label = f"{route.method} {route.path}"
+    token = _current_route.set(label)
+    spent = [0.0]
+    spent_token = _round_trip_seconds.set(spent)
+    bot.metrics.inc('discord_calls_total', label)
+    started = time.perf_counter()
+    try:
+        with bot.metrics.timer('discord_request_seconds', label):
+            return await _discord_request(route, **kwargs)
+    except discord.HTTPException as e:
+        bot.metrics.inc('discord_http_errors_total', f"{label} {e.status}")
+        raise
+    finally:
+        waited = time.perf_counter() - started - spent[0]
+        if waited >= RATELIMIT_WAIT_FLOOR:
+            bot.metrics.inc('ratelimit_wait_seconds_total', label, waited)
+        _round_trip_seconds.reset(spent_token)
+        _current_route.reset(token)
+
+bot.http.request = metered_request
+
+class RateLimitMeter(logging.Handler):
+    """Count 429s from discord.py's rate limit warnings, their waits are measured by metered_request"""
+
+    def emit(self, record):
+        message = str(record.msg)
+        if message.startswith('We are being rate limited'):
+            bot.metrics.inc('discord_429_total', _current_route.get())
+        elif message.startswith('Global rate limit has been hit'):
+            bot.metrics.inc('discord_global_429_total')
+
+logging.getLogger('discord.http').addHandler(RateLimitMeter(logging.WARNING))
+
+async def serve_metrics(reader, writer):
+    """Answer any request on the metrics port with the Prometheus text page"""
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+        body = bot.metrics.render_prometheus().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    if not METRICS_PORT or getattr(bot, 'metrics_server', None):
+        return
+    bot.metrics_server = await asyncio.start_server(serve_metrics, '127.0.0.1', METRICS_PORT)
+    log.info(f"📈 Metrics served on http://127.0.0.1:{METRICS_PORT}/metrics")
+
+# ----------------------------
+# PERSISTENT STATE
+# ----------------------------
+class StateStore:
+    """SQLite (WAL) store mirroring the in-memory roster, invites and invite tracker.
+
+    Every mutation is written through immediately so a restart mid-event keeps
+    the email -> invite mapping and the usage counts needed for attribution.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS members (
+        guild_id INTEGER NOT NULL,
+        team TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        email TEXT NOT NULL,
+        record TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS members_guild ON members (guild_id, team, position);
+    CREATE TABLE IF NOT EXISTS invites (
+        url TEXT PRIMARY KEY,
+        code TEXT NOT NULL UNIQUE,
+        guild_id INTEGER NOT NULL,
+        team TEXT NOT NULL,
+        member_email TEXT
+    );
+    CREATE INDEX IF NOT EXISTS invites_member ON invites (guild_id, team, member_email);
+    CREATE TABLE IF NOT EXISTS invite_uses (
+        guild_id INTEGER NOT NULL,
+        code TEXT NOT NULL,
+        uses INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, code)
+    );
+    CREATE TABLE IF NOT EXISTS joined_members (
+        guild_id INTEGER NOT NULL,
+        team TEXT NOT NULL,
+        email TEXT NOT NULL,
+        member_id INTEGER,
+        PRIMARY KEY (guild_id, team, email)
+    );
+    CREATE TABLE IF NOT EXISTS claim_codes (
+        code TEXT PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        team TEXT NOT NULL,
+        email TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS claim_landings (
+        guild_id INTEGER PRIMARY KEY,
+        url TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS outbox (
+        guild_id INTEGER NOT NULL,
+        team TEXT NOT NULL,
+        email TEXT NOT NULL,
+        invite_url TEXT NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL,
+        error TEXT,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (guild_id, team, email)
+    );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None)  # Autocommit, explicit transactions for bulk writes
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self._migrate_members()
+        self.db.executescript(self.SCHEMA)
+
+    def _migrate_members(self):
+        """Rosters used to be global: give old rows the guild their invites belong to"""
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(members)")}
+        if not columns or 'guild_id' in columns:
+            return
+        self.db.execute("ALTER TABLE members ADD COLUMN guild_id INTEGER NOT NULL DEFAULT 0")
+        self.db.execute("DROP INDEX IF EXISTS members_team")
+        guilds = [guild_id for (guild_id,) in self.db.execute("SELECT DISTINCT guild_id FROM invites")]
+        if len(guilds) == 1:
+            self.db.execute("UPDATE members SET guild_id = ?", (guilds[0],))
+        else:
+            log.warning("⚠️ The saved roster isn't tied to a server yet, run /load again in the right server")
+
+    @staticmethod
+    def _to_json(record):
+        # pandas hands back numpy scalars, unwrap them to plain Python values
+        return json.dumps(record, default=lambda v: v.item() if hasattr(v, 'item') else str(v))
+
+    def load_rosters(self):
+        rosters = {}
+        for guild_id, record in self.db.execute(
+            "SELECT guild_id, record FROM members ORDER BY guild_id, team, position"
+        ):
+            rosters.setdefault(guild_id, []).append(json.loads(record))
+        return rosters
+
+    def load_invites(self):
+        return {
+            url: {'team': team, 'member_email': member_email, 'guild_id': guild_id}
+            for url, guild_id, team, member_email in self.db.execute(
+                "SELECT url, guild_id, team, member_email FROM invites"
+            )
+        }
+
+    def load_invite_uses(self):
+        tracker = {}
+        for guild_id, code, uses in self.db.execute("SELECT guild_id, code, uses FROM invite_uses"):
+            tracker.setdefault(guild_id, {})[code] = uses
+        return tracker
+
+    def load_joined(self):
+        return {
+            (guild_id, team, email): member_id
+            for guild_id, team, email, member_id in self.db.execute("SELECT * FROM joined_members")
+        }
+
+    def load_outbox(self):
+        return {
+            (guild_id, team, email): {'invite_url': invite_url, 'status': status, 'attempts': attempts, 'error': error}
+            for guild_id, team, email, invite_url, status, attempts, error in self.db.execute(
+                "SELECT guild_id, team, email, invite_url, status, attempts, error FROM outbox"
+            )
+        }
+
+    def load_claim_codes(self):
+        return {
+            code: (guild_id, team, email)
+            for code, guild_id, team, email in self.db.execute("SELECT code, guild_id, team, email FROM claim_codes")
+        }
+
+    def load_claim_landings(self):
+        return dict(self.db.execute("SELECT guild_id, url FROM claim_landings"))
+
+    async def replace_roster(self, guild_id, roster):
+        """Swap a guild's saved roster in one transaction without blocking the event loop"""
+        rows = await asyncio.to_thread(self._roster_rows, guild_id, roster)  # JSON encoding is the slow part
+        if self.path == ':memory:':
+            return self._write_roster(self.db, guild_id, rows)  # A second connection would open an empty database
+        await asyncio.to_thread(self._write_roster_on_own_connection, guild_id, rows)
+
+    def _roster_rows(self, guild_id, roster):
+        return [
+            (guild_id, team, position, member.email, self._to_json(member._asdict()))
+            for team, members in roster.items()
+            for position, member in enumerate(members)
+        ]
+
+    def _write_roster_on_own_connection(self, guild_id, rows):
+        # Never the loop's connection: an explicit transaction there would swallow or break the loop's own writes
+        db = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+        try:
+            db.execute("PRAGMA synchronous=NORMAL")
+            # Stage in a temp table first, which doesn't lock the database, so the loop's writes
+            # only ever wait for the final copy
+            db.execute("CREATE TEMP TABLE staged_members AS SELECT * FROM members WHERE 0")
+            db.executemany("INSERT INTO staged_members (guild_id, team, position, email, record) VALUES (?, ?, ?, ?, ?)", rows)
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                db.execute("DELETE FROM members WHERE guild_id = ?", (guild_id,))
+                db.execute("INSERT INTO members SELECT * FROM staged_members")
+        finally:
+            db.close()
+
+    @staticmethod
+    def _write_roster(db, guild_id, rows):
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("DELETE FROM members WHERE guild_id = ?", (guild_id,))
+            db.executemany("INSERT INTO members (guild_id, team, position, email, record) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def save_invite(self, url, code, data):
+        self.db.execute(
+            "INSERT OR REPLACE INTO invites VALUES (?, ?, ?, ?, ?)",
+            (url, code, data['guild_id'], str(data['team']),
+             str(data['member_email']) if data.get('member_email') else None)
+        )
+
+    def delete_invite(self, url):
+        self.db.execute("DELETE FROM invites WHERE url = ?", (url,))
+
+    def clear_invites(self):
+        self.db.execute("DELETE FROM invites")
+
+    def save_uses(self, guild_id, code, uses):
+        self.db.execute("INSERT OR REPLACE INTO invite_uses VALUES (?, ?, ?)", (guild_id, code, uses))
+
+    def delete_uses(self, guild_id, code):
+        self.db.execute("DELETE FROM invite_uses WHERE guild_id = ? AND code = ?", (guild_id, code))
+
+    def save_joined(self, key, member_id):
+        self.db.execute("INSERT OR REPLACE INTO joined_members VALUES (?, ?, ?, ?)", (*key, member_id))
+
+    def delete_joined(self, key):
+        self.db.execute("DELETE FROM joined_members WHERE guild_id = ? AND team = ? AND email = ?", key)
+
+    def save_claim_codes(self, codes):
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR REPLACE INTO claim_codes VALUES (?, ?, ?, ?)", ((code, *key) for code, key in codes))
+
+    def delete_claim_code(self, code):
+        self.db.execute("DELETE FROM claim_codes WHERE code = ?", (code,))
+
+    def save_claim_landing(self, guild_id, url):
+        self.db.execute("INSERT OR REPLACE INTO claim_landings VALUES (?, ?)", (guild_id, url))
+
+    def clear_guild(self, guild_id):
+        """Forget everything saved for one guild's event"""
+        with self.db:
+            self.db.execute("BEGIN")
+            for table in ('members', 'invites', 'invite_uses', 'joined_members', 'claim_codes', 'claim_landings', 'outbox'):
+                self.db.execute(f"DELETE FROM {table} WHERE guild_id = ?", (guild_id,))
+
+    def get_setting(self, key):
+        row = self.db.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_setting(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", (key, value))
+
+    def save_outbox(self, key, entry):
+        self.db.execute(
+            "INSERT OR REPLACE INTO outbox VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (*key, entry['invite_url'], entry['status'], entry['attempts'], entry['error'], time.time())
+        )
+
+bot.store = StateStore(os.getenv('STATE_DB', 'team_manager.db'))
 
 # Data storage
-bot.team_data = {}  # {team_name: [user_dicts]}
-bot.invite_links = {}  # {invite_url: team_name}
-bot.invite_tracker = {}  # Tracks invite usage counts
+RosterMember = collections.namedtuple('RosterMember', ['firstname', 'lastname', 'email', 'team'])
+
+class Roster:
+    """One guild's participants stored by column, grouped by team.
+
+    Each member is a single packed string plus a team id into a list of
+    interned team names, a fraction of a per-member dict. RosterMember tuples
+    are built on demand. Position arrays sorted by email and by name answer
+    lookups with a binary search.
+    """
+
+    SEPARATOR = "\x1f"
+
+    def __init__(self, members=()):
+        teams = {}
+        for member in members:
+            packed = self.SEPARATOR.join((member.firstname, member.lastname, member.email))
+            teams.setdefault(sys.intern(member.team), []).append(packed)
+
+        self.teams = list(teams)  # Team names in roster order
+        self.ranges = {}  # {team_name: (start, stop)} positions of its members
+        self.packed = []  # "firstname\x1flastname\x1femail" per position
+        self.team_ids = array.array('I')  # Index into self.teams per position
+        for team_id, (team_name, packed) in enumerate(teams.items()):
+            self.ranges[team_name] = (len(self.packed), len(self.packed) + len(packed))
+            self.packed.extend(packed)
+            self.team_ids.extend(itertools.repeat(team_id, len(packed)))
+
+        positions = range(len(self.packed))
+        self.by_email = array.array('I', sorted(positions, key=self._email_key))
+        self.by_name = array.array('I', sorted(positions, key=self._name_key))
+        self.by_last_name = array.array('I', sorted(positions, key=self._last_name_key))
+
+    @classmethod
+    def from_records(cls, records):
+        """Build from plain {'firstname', 'lastname', 'email', 'team'} dicts"""
+        return cls(RosterMember(*(str(record.get(field, '')) for field in RosterMember._fields)) for record in records)
+
+    def _email_key(self, position):
+        return self.packed[position].rpartition(self.SEPARATOR)[2].lower()
+
+    def _name_key(self, position):
+        firstname, lastname, _ = self.packed[position].split(self.SEPARATOR)
+        return f"{firstname} {lastname}".lower()
+
+    def _last_name_key(self, position):
+        firstname, lastname, _ = self.packed[position].split(self.SEPARATOR)
+        return f"{lastname} {firstname}".lower()
+
+    def member(self, position):
+        firstname, lastname, email = self.packed[position].split(self.SEPARATOR)
+        return RosterMember(firstname, lastname, email, self.teams[self.team_ids[position]])
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __iter__(self):
+        return iter(self.teams)
+
+    def __contains__(self, team_name):
+        return team_name in self.ranges
+
+    def items(self):
+        """(team_name, [RosterMember]) per team, like the old {team: [members]} dict"""
+        for team_name, (start, stop) in self.ranges.items():
+            yield team_name, [self.member(position) for position in range(start, stop)]
+
+    def members(self):
+        return (self.member(position) for position in range(len(self.packed)))
+
+    def find_email(self, email):
+        """Case-insensitive exact email lookup"""
+        email = email.strip().lower()
+        i = bisect.bisect_left(self.by_email, email, key=self._email_key)
+        if i < len(self.by_email) and self._email_key(self.by_email[i]) == email:
+            return self.member(self.by_email[i])
+        return None
+
+    def search(self, query, limit=25):
+        """Members whose email, 'first last' or 'last first' name starts with the query"""
+        query = " ".join(query.split()).lower()
+        found = {}  # Ordered set of positions
+        for index, key in (
+            (self.by_email, self._email_key), (self.by_name, self._name_key), (self.by_last_name, self._last_name_key)
+        ):
+            i = bisect.bisect_left(index, query, key=key)
+            while i < len(index) and len(found) < limit and key(index[i]).startswith(query):
+                found[index[i]] = None
+                i += 1
+        return [self.member(position) for position in found]
+
+class GuildState:
+    """Roster, invites and attribution state of one guild, so guilds never share or scan each other's data.
+
+    Member keys keep the (guild_id, team_name, member_email) shape of invite_key()
+    so they can be written to the store as-is.
+    """
+
+    __slots__ = (
+        'roster', 'invite_links', 'invite_codes', 'invite_index', 'invite_tracker', 'joined_members',
+        'outbox', 'outbox_inflight', 'claim_codes', 'member_claims', 'claim_landing',
+        'unclaimed_invites', 'join_started', 'dead_invites'
+    )
+
+    def __init__(self):
+        self.roster = Roster()
+        self.invite_links = {}  # {invite_url: {'team', 'member_email', 'guild_id'}}
+        self.invite_codes = {}  # {invite_code: invite_url}
+        self.invite_index = {}  # {member_key: invite_url}
+        self.invite_tracker = {}  # {invite_code: uses} usage counts at the last snapshot
+        self.joined_members = {}  # {member_key: discord member id or None if unknown}
+        self.outbox = {}  # {member_key: {'invite_url', 'status', 'attempts', 'error'}} per-recipient email state
+        self.outbox_inflight = set()  # Outbox keys being delivered right now, so overlapping runs never double-send
+        self.claim_codes = {}  # {claim_code: member_key}
+        self.member_claims = {}  # {member_key: claim_code}
+        self.claim_landing = None  # Shared invite URL of the claim landing channel
+        self.unclaimed_invites = []  # [(seen_at, invite_url, invite_data)] consumed before their join was seen
+        self.join_started = {}  # {member_id: monotonic time the join event arrived} for join-to-role latency
+        self.dead_invites = {}  # {member_key: invite_url} revoked or expired before their member joined
+
+bot.guild_states = {}  # {guild_id: GuildState}
+
+def guild_state(guild_id):
+    if guild_id not in bot.guild_states:
+        bot.guild_states[guild_id] = GuildState()
+    return bot.guild_states[guild_id]
+
+def invite_code(invite_url):
+    """Extract the invite code from a discord.gg URL"""
+    return invite_url.rstrip("/").rsplit("/", 1)[-1]
+
+def invite_key(guild_id, team_name, member_email):
+    """Normalized reverse-index key for a member's invite"""
+    return guild_id, team_name, str(member_email).strip().lower()
+
+def register_invite(invite_url, data):
+    """Store invite data and keep the reverse index in sync"""
+    if invite_url in guild_state(data['guild_id']).invite_links:
+        unregister_invite(data['guild_id'], invite_url)
+    _index_invite(invite_url, data)
+    bot.store.save_invite(invite_url, invite_code(invite_url), data)
+
+def _index_invite(invite_url, data):
+    state = guild_state(data['guild_id'])
+    state.invite_links[invite_url] = data
+    state.invite_codes[invite_code(invite_url)] = invite_url
+    if data.get('member_email'):
+        key = invite_key(data['guild_id'], data['team'], data['member_email'])
+        state.invite_index[key] = invite_url
+        state.dead_invites.pop(key, None)
+
+def unregister_invite(guild_id, invite_url):
+    """Forget an invite and drop its reverse-index entry"""
+    state = guild_state(guild_id)
+    data = state.invite_links.pop(invite_url, None)
+    state.invite_codes.pop(invite_code(invite_url), None)
+    bot.store.delete_invite(invite_url)
+    if data and data.get('member_email'):
+        key = invite_key(guild_id, data['team'], data['member_email'])
+        if state.invite_index.get(key) == invite_url:
+            del state.invite_index[key]
+    return data
+
+def find_member_invite(guild_id, team_name, member_email):
+    """O(1) lookup of the invite created for a member"""
+    return guild_state(guild_id).invite_index.get(invite_key(guild_id, team_name, member_email))
+
+def mark_member_joined(data, member_id=None):
+    """Remember that a member used their invite so it is never minted again"""
+    if data.get('member_email'):
+        joined_members = guild_state(data['guild_id']).joined_members
+        key = invite_key(data['guild_id'], data['team'], data['member_email'])
+        if member_id is None and joined_members.get(key):
+            return  # Keep the Discord id we already matched
+        joined_members[key] = member_id
+        bot.store.save_joined(key, member_id)
+
+def forget_member_joined(key):
+    """Drop a member's join record, returns the Discord id it held"""
+    member_id = guild_state(key[0]).joined_members.pop(key, None)
+    bot.store.delete_joined(key)
+    return member_id
+
+def track_invite(guild_id, code, uses):
+    """Record the usage count of a bot invite for join detection"""
+    guild_state(guild_id).invite_tracker[code] = uses
+    bot.store.save_uses(guild_id, code, uses)
+
+def tracked_uses(guild_id, invite_url):
+    """Usage count of an invite as of the last snapshot"""
+    return guild_state(guild_id).invite_tracker.get(invite_code(invite_url), 0)
+
+def consume_invite_snapshot(guild_id, current_invites):
+    """Diff a fresh guild.invites() snapshot against the tracker.
+
+    Returns [(invite_url, invite_data)] for every bot invite used since the last
+    snapshot: tracked codes that vanished (single-use invites are deleted once
+    used) plus codes whose use count went up. The tracker is advanced to the
+    new snapshot and vanished invites are unregistered.
+    """
+    state = guild_state(guild_id)
+    tracked = state.invite_tracker
+    live = {invite.code: invite.uses for invite in current_invites}
+
+    consumed = []
+    for code in tracked.keys() - live.keys():
+        del tracked[code]
+        bot.store.delete_uses(guild_id, code)
+        invite_url = state.invite_codes.get(code)
+        data = unregister_invite(guild_id, invite_url) if invite_url else None
+        if data:
+            consumed.append((invite_url, data))
+
+    for code in tracked.keys() & live.keys():
+        if live[code] > tracked[code]:
+            track_invite(guild_id, code, live[code])
+            invite_url = state.invite_codes.get(code)
+            if invite_url in state.invite_links:
+                consumed.append((invite_url, state.invite_links[invite_url]))
+    return consumed
+
+def load_state():
+    """Restore rosters, invites and usage counts saved by a previous run"""
+    for guild_id, records in bot.store.load_rosters().items():
+        guild_state(guild_id).roster = Roster.from_records(records)
+    for guild_id, tracker in bot.store.load_invite_uses().items():
+        guild_state(guild_id).invite_tracker = tracker
+    for key, member_id in bot.store.load_joined().items():
+        guild_state(key[0]).joined_members[key] = member_id
+    for key, entry in bot.store.load_outbox().items():
+        if entry['status'] == 'sending':
+            # We stopped between handing the message to SMTP and hearing back, don't resend it blindly
+            entry.update(status='failed', error="Interrupted mid-send, may have been delivered")
+            bot.store.save_outbox(key, entry)
+        guild_state(key[0]).outbox[key] = entry
+    for code, key in bot.store.load_claim_codes().items():
+        state = guild_state(key[0])
+        state.claim_codes[code] = key
+        state.member_claims[key] = code
+    for guild_id, url in bot.store.load_claim_landings().items():
+        guild_state(guild_id).claim_landing = url
+    for invite_url, data in bot.store.load_invites().items():
+        _index_invite(invite_url, data)
+    for guild_id, state in bot.guild_states.items():
+        if state.roster or state.invite_links:
+            log.info(
+                f"💾 Restored {len(state.roster)} users "
+                f"and {len(state.invite_links)} invites for server {guild_id}"
+            )
+
+def parse_invite_reason(reason):
+    """Recover (team, email) from a 'Team:<team> Member:<email>' audit reason"""
+    if not reason or "Team:" not in reason:
+        return "Unknown", None
+    team_part = reason.split("Team:", 1)[1]
+    member_email = None
+    if " Member:" in team_part:
+        team_part, member_email = team_part.split(" Member:", 1)
+        member_email = member_email.strip() or None
+    return team_part.strip() or "Unknown", member_email
+
+load_state()
+
+# ----------------------------
+# GUILD NAME INDEX
+# ----------------------------
+CHANNEL_KINDS = {
+    discord.ChannelType.text: 'text',
+    discord.ChannelType.news: 'text',
+    discord.ChannelType.voice: 'voice',
+    discord.ChannelType.category: 'category',
+}
+
+class GuildIndex:
+    """Normalized name -> object maps for one guild's roles, channels and categories.
+
+    Built once from the guild cache, then kept current by the role/channel events
+    so lookups don't scan guild.roles or guild.channels.
+    """
+
+    def __init__(self, guild):
+        self.maps = {'role': {}, 'text': {}, 'voice': {}, 'category': {}}
+        for role in guild.roles:
+            self.add('role', role)
+        for channel in guild.channels:
+            self.add(CHANNEL_KINDS.get(channel.type), channel)
+
+    @staticmethod
+    def normalize(name):
+        return name.strip().lower()
+
+    def add(self, kind, obj):
+        if kind:
+            # Several objects can share a name, keep them all by id
+            self.maps[kind].setdefault(self.normalize(obj.name), {})[obj.id] = obj
+
+    def remove(self, kind, obj, name=None):
+        if not kind:
+            return
+        key = self.normalize(name or obj.name)
+        entries = self.maps[kind].get(key)
+        if entries:
+            entries.pop(obj.id, None)
+            if not entries:
+                del self.maps[kind][key]
+
+    def get(self, kind, name):
+        entries = self.maps[kind].get(self.normalize(name))
+        return next(iter(entries.values())) if entries else None
+
+    def all(self, kind):
+        return [obj for entries in self.maps[kind].values() for obj in entries.values()]
+
+bot.guild_indexes = {}  # {guild_id: GuildIndex}
+
+def guild_index(guild):
+    """Name index for a guild, built on first use"""
+    index = bot.guild_indexes.get(guild.id)
+    if index is None:
+        index = bot.guild_indexes[guild.id] = GuildIndex(guild)
+    return index
+
+@metered_event
+async def on_guild_role_create(role):
+    if role.guild.id in bot.guild_indexes:
+        bot.guild_indexes[role.guild.id].add('role', role)
+
+@metered_event
+async def on_guild_role_delete(role):
+    if role.guild.id in bot.guild_indexes:
+        bot.guild_indexes[role.guild.id].remove('role', role)
+
+@metered_event
+async def on_guild_role_update(before, after):
+    if after.guild.id in bot.guild_indexes:
+        index = bot.guild_indexes[after.guild.id]
+        index.remove('role', before)
+        index.add('role', after)
+
+@metered_event
+async def on_guild_channel_create(channel):
+    if channel.guild.id in bot.guild_indexes:
+        bot.guild_indexes[channel.guild.id].add(CHANNEL_KINDS.get(channel.type), channel)
+    slots = bot.category_slots.get(channel.guild.id)
+    if slots:
+        if channel.type == discord.ChannelType.category:
+            slots.add_category(channel.name, channel.channels)
+        else:
+            slots.channel_added(channel)
+
+@metered_event
+async def on_guild_channel_delete(channel):
+    if channel.guild.id in bot.guild_indexes:
+        bot.guild_indexes[channel.guild.id].remove(CHANNEL_KINDS.get(channel.type), channel)
+    slots = bot.category_slots.get(channel.guild.id)
+    if slots:
+        if channel.type == discord.ChannelType.category:
+            slots.remove_category(channel.name)
+        else:
+            slots.channel_removed(channel)
+
+@metered_event
+async def on_guild_channel_update(before, after):
+    if after.guild.id in bot.guild_indexes:
+        index = bot.guild_indexes[after.guild.id]
+        index.remove(CHANNEL_KINDS.get(before.type), before)
+        index.add(CHANNEL_KINDS.get(after.type), after)
+    slots = bot.category_slots.get(after.guild.id)
+    if slots:
+        if after.type == discord.ChannelType.category:
+            if before.name != after.name:
+                slots.remove_category(before.name)
+                slots.add_category(after.name, after.channels)
+        elif before.category != after.category:
+            slots.channel_removed(before)
+            slots.channel_added(after)
+
+@metered_event
+async def on_guild_remove(guild):
+    bot.guild_indexes.pop(guild.id, None)
+    bot.category_slots.pop(guild.id, None)
 
 # ----------------------------
 # BOT SETUP AND CHANNEL MANAGEMENT
 # ----------------------------
+GUILD_INIT_CONCURRENCY = int(os.getenv('GUILD_INIT_CONCURRENCY', 8))  # Guilds initialized in parallel on startup
+GUILD_INIT_TIMEOUT = float(os.getenv('GUILD_INIT_TIMEOUT', 30))  # Seconds before a slow guild is skipped
+test_guild = discord.Object(id=1354521624734784681)  # Insert your Discord server ID for faster command sync
+
+bot.ready_count = 0  # on_ready fires again after every gateway re-identify
+
+def command_tree_hash(guild):
+    """Fingerprint of the slash command payload Discord would receive for a guild"""
+    payload = sorted((command.to_dict() for command in bot.tree.get_commands(guild=guild)), key=lambda c: c['name'])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+async def sync_command_tree():
+    """Sync commands to the test guild only when their definitions changed since the last sync"""
+    bot.tree.copy_global_to(guild=test_guild)
+    setting = f"command_tree:{test_guild.id}"
+    fingerprint = command_tree_hash(test_guild)
+    if bot.store.get_setting(setting) == fingerprint:
+        log.info("⚡ Slash commands unchanged, skipping sync")
+        return
+    try:
+        synced = await bot.tree.sync(guild=test_guild)
+    except discord.HTTPException as e:
+        log.error(f"❌ Couldn't sync slash commands: {str(e)}")
+        return
+    bot.store.set_setting(setting, fingerprint)
+    log.info(f"🔄 Synced {len(synced)} slash commands")
+
 @bot.event
+async def setup_hook():
+    """One-time startup, runs after login and before the gateway connects"""
+    await start_metrics_server()
+    bot.add_view(ClaimView())  # Claim buttons posted before a restart keep working
+    await sync_command_tree()
+    if INVITE_RECONCILE_INTERVAL:
+        reconcile_invites.start()
+
+@metered_event
 async def on_ready():
-    """Initialize bot and setup channels"""
-    print(f'Logged in as {bot.user}')
-    
-    # Sync commands to specific guild for faster updates
-    test_guild = discord.Object(id=1354521624734784681)  # Insert your Discord server ID for faster command sync
-    bot.tree.copy_global_to(guild=test_guild)
-    await bot.tree.sync(guild=test_guild)
-    
-    # Initialize invite tracker with only bot-created invites
-    bot.invite_tracker = {}
-    for guild in bot.guilds:
-        try:
-            if not guild.me.guild_permissions.manage_guild:
-                print(f"❌ Missing MANAGE_GUILD permission in {guild.name} - invite tracking disabled")
-                continue
-                
+    """Initialize guilds, again after every reconnect since events may have been missed"""
+    bot.ready_count += 1
+    reconnect = bot.ready_count > 1
+    if reconnect:
+        # The new session rebuilt the guild cache, indexes must not hold on to the old objects
+        bot.guild_indexes.clear()
+        bot.category_slots.clear()
+        log.info(f'Reconnected as {bot.user}')
+    else:
+        log.info(f'Logged in as {bot.user}')
+
+    # Initialize guilds concurrently so time-to-ready follows the slowest guild, not the sum
+    started = time.perf_counter()
+    limiter = asyncio.Semaphore(GUILD_INIT_CONCURRENCY)
+
+    async def init_with_limits(guild):
+        async with limiter:
+            log_context.set({'guild': guild.id})
+            guild_started = time.perf_counter()
+            try:
+                await asyncio.wait_for(init_guild(guild, reconnect), timeout=GUILD_INIT_TIMEOUT)
+                timed_out = False
+            except asyncio.TimeoutError:
+                log.warning(f"⚠️ Initialization of {guild.name} timed out after {GUILD_INIT_TIMEOUT:g}s")
+                timed_out = True
+            return guild, time.perf_counter() - guild_started, timed_out
+
+    results = await asyncio.gather(*(init_with_limits(guild) for guild in bot.guilds))
+    if results:
+        slowest_guild, slowest_time, _ = max(results, key=lambda r: r[1])
+        timeouts = sum(1 for _, _, timed_out in results if timed_out)
+        log.info(
+            f"⏱️ Ready in {time.perf_counter() - started:.2f}s across {len(results)} guild(s) "
+            f"(slowest: {slowest_guild.name} {slowest_time:.2f}s, timeouts: {timeouts})"
+        )
+
+async def init_guild(guild, reconnect=False):
+    """Refresh invite tracking for one guild, and set up its bot channel on startup"""
+    if reconnect:
+        return await refresh_guild_invites(guild)
+    await asyncio.gather(refresh_guild_invites(guild), setup_bot_channel(guild))
+
+async def refresh_guild_invites(guild):
+    """Refresh the restored invite tracker with only bot-created invites"""
+    try:
+        if not guild.me.guild_permissions.manage_guild:
+            log.error(f"❌ Missing MANAGE_GUILD permission in {guild.name} - invite tracking disabled")
+            return
+
+        state = guild_state(guild.id)
+        async with snapshot_lock(guild.id):
             guild_invites = await guild.invites()
-            # Track all valid invites regardless of creation time
-            # In on_ready() invite tracking:
-            for invite in guild_invites:
-                if invite.inviter == bot.user:
-                    # Handle invites without reasons safely
-                    team_name = "Unknown"
-                    try:
-                        if invite.reason and ":" in invite.reason:
-                            team_name = invite.reason.split(":")[1].strip()
-                    except AttributeError:
-                        pass  # Handle legacy invites without reason field
-            
-                    # Fix guild context reference
-                    bot.invite_links[invite.url] = {
-                        'team': team_name,
-                        'guild_id': guild.id  # Changed from ctx.guild.id
-                    }
-            
-            # In create_invites command:
-                    invite = await ctx.channel.create_invite(
-                        max_uses=5,
-                        unique=True,
-                        reason=f"Team:{team_name}",
-                        max_age=0  # infinite
-                    )
-            
-            # In assign_team_role function:
-                    role = await guild.create_role(
-                        name=role_name,
-                        color=discord.Color.random(),
-                        hoist=True,
-                        mentionable=True,
-                        reason=f"auto-created for {team_name}",
-                        position=guild.me.top_role.position - 1  # Position below bot's role
-                    )
-            
-            # Store guild ID with invite data
-            bot.invite_links[invite.url] = {
-                'team': team_name,
-                'guild_id': ctx.guild.id
-            }
-            # NOT: bot.invite_links[invite.url] = team_name
-            bot.invite_tracker[invite.url] = invite.uses
-            print(f"🔗 Tracking invite {invite.url} (uses: {invite.uses}) in {guild.name}")
-        
-        except discord.Forbidden as e:
-            print(f"Permission error in {guild.name}: {str(e)}")
-        except Exception as e:
-            print(f"Error processing invites in {guild.name}: {str(e)}")
-    
-    # Setup bot channels in all guilds
-    for guild in bot.guilds:
-        await setup_bot_channel(guild)
+            # Invites used or revoked while we were offline can't be attributed to a join anymore
+            missed = consume_invite_snapshot(guild.id, guild_invites)
+        if missed:
+            # Most of these were used, count their members as joined so they aren't minted or emailed again
+            for _, data in missed:
+                mark_member_joined(data)
+            emails = ", ".join(data['member_email'] for _, data in missed if data.get('member_email'))
+            log.warning(f"⚠️ {len(missed)} tracked invites were used or revoked while offline in {guild.name}, "
+                        f"check the team roles of: {emails or 'no roster members'}")
+
+        # Track all valid invites regardless of creation time
+        for invite in guild_invites:
+            if invite.inviter != bot.user or invite.url == state.claim_landing:
+                continue
+
+            # Keep what we already know, otherwise recover it from the audit reason
+            if invite.url not in state.invite_links:
+                # Handle invites without reasons safely (legacy invites have no reason field)
+                team_name, member_email = parse_invite_reason(getattr(invite, 'reason', None))
+                register_invite(invite.url, {
+                    'team': team_name,
+                    'member_email': member_email,
+                    'guild_id': guild.id
+                })
+            track_invite(guild.id, invite.code, invite.uses)
+            log.debug("🔗 Tracking invite %s (uses: %s) in %s", invite.url, invite.uses, guild.name)
+
+    except discord.Forbidden as e:
+        log.warning(f"Permission error in {guild.name}: {str(e)}")
+    except Exception as e:
+        log.error(f"Error processing invites in {guild.name}: {str(e)}")
 
 async def setup_bot_channel(guild):
     """Create or verify the bot's dedicated channel with proper permissions"""
-    channel = discord.utils.get(guild.text_channels, name="teammanagerbot")
+    channel = guild_index(guild).get('text', "teammanagerbot")
     if not channel:
         try:
             overwrites = {
@@ -120,584 +1085,2098 @@ async def setup_bot_channel(guild):
                 overwrites=overwrites,
                 reason="Bot command channel with proper permissions"
             )
+            guild_index(guild).add('text', channel)
             await channel.send("Bot command center ready!")
         except discord.Forbidden:
-            print(f"Missing permissions to create channels in {guild.name}")
+            log.warning(f"Missing permissions to create channels in {guild.name}")
         except Exception as e:
-            print(f"Error creating channel in {guild.name}: {e}")
+            log.error(f"Error creating channel in {guild.name}: {e}")
 
 # ----------------------------
 # DATA LOADING SYSTEM
 # ----------------------------
-@bot.hybrid_command(name="load", description="Load user data from Excel")
+REQUIRED_COLUMNS = ['firstname', 'lastname', 'email', 'team']
+EMAIL_PATTERN = r"^[^@\s]+@[^@\s]+\.[^@\s]+$"
+CSV_CHUNK_ROWS = 10000
+
+class RosterError(ValueError):
+    """The roster file can't be loaded at all (wrong format, missing columns)"""
+
+def _cell_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # Excel stores team numbers as floats
+    return str(value).strip()
+
+def read_roster_frame(source, filename):
+    """Stream-parse a CSV or XLSX roster, keeping only the required columns as strings"""
+    import pandas as pd  # Heavy, only loaded with the first roster
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.csv':
+        chunks = pd.read_csv(
+            source,
+            dtype=str,
+            keep_default_na=False,
+            chunksize=CSV_CHUNK_ROWS,
+            usecols=lambda column: str(column).strip().lower() in REQUIRED_COLUMNS
+        )
+        frames = [chunk.rename(columns=lambda column: str(column).strip().lower()) for chunk in chunks]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    if extension in ('.xlsx', '.xlsm'):
+        import openpyxl
+        workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [_cell_text(cell).lower() for cell in next(rows, ())]
+            wanted = {name: i for i, name in enumerate(header) if name in REQUIRED_COLUMNS}
+            columns = {name: [] for name in wanted}
+            for row in rows:
+                for name, i in wanted.items():
+                    columns[name].append(_cell_text(row[i]) if i < len(row) else '')
+            return pd.DataFrame(columns)
+        finally:
+            workbook.close()
+
+    if extension == '.xls':
+        df = pd.read_excel(source, dtype=str, keep_default_na=False)
+        df.columns = [str(column).strip().lower() for column in df.columns]
+        return df[[column for column in df.columns if column in REQUIRED_COLUMNS]]
+
+    raise RosterError(f"Unsupported file type '{extension or filename}', use .csv or .xlsx")
+
+def validate_roster(df):
+    """Check every row in one vectorized pass.
+
+    Returns (valid rows, [(row_number, reason)]) where row numbers match the
+    spreadsheet (header is row 1). Fully blank rows are dropped silently.
+    """
+    import pandas as pd
+    missing = [column for column in REQUIRED_COLUMNS if column not in df.columns]
+    if missing:
+        raise RosterError(f"Missing required columns: {', '.join(missing)}")
+
+    df = df[REQUIRED_COLUMNS].apply(lambda column: column.astype(str).str.strip())
+    df = df[(df != '').any(axis=1)]
+
+    blank = df == ''
+    reasons = pd.Series('', index=df.index)
+    for column in REQUIRED_COLUMNS:
+        reasons = reasons.mask(blank[column], reasons + f"missing {column}, ")
+    has_email = ~blank['email']
+    reasons = reasons.mask(has_email & ~df['email'].str.match(EMAIL_PATTERN), reasons + "invalid email, ")
+    reasons = reasons.mask(has_email & df['email'].str.lower().duplicated(), reasons + "duplicate email, ")
+
+    bad = reasons != ''
+    errors = [(index + 2, reason.rstrip(', ')) for index, reason in reasons[bad].items()]
+    return df[~bad], errors
+
+def load_roster_file(source, filename):
+    """Parse and validate a roster, returns (Roster, errors). Blocking, run it in a thread."""
+    valid, errors = validate_roster(read_roster_frame(source, filename))
+    rows = valid.sort_values('team', kind='stable')[REQUIRED_COLUMNS].itertuples(index=False, name=None)
+    return Roster(RosterMember(*row) for row in rows), errors
+
+def describe_roster_errors(errors, limit=15):
+    lines = [f"⚠️ Skipped {len(errors)} invalid row(s):"]
+    lines.extend(f"• Row {row}: {reason}" for row, reason in errors[:limit])
+    if len(errors) > limit:
+        lines.append(f"(+{len(errors) - limit} more)")
+    return "\n".join(lines)
+
+def diff_rosters(old, new):
+    """Compare two rosters by email.
+
+    Returns added/removed as (team, member), moved as (old_team, new_team, member)
+    and the lists of new and emptied teams.
+    """
+    def by_email(roster):
+        return {member.email.strip().lower(): (member.team, member) for member in roster.members()}
+
+    old_members, new_members = by_email(old), by_email(new)
+    return {
+        'previous': bool(old),
+        'added': [entry for email, entry in new_members.items() if email not in old_members],
+        'removed': [entry for email, entry in old_members.items() if email not in new_members],
+        'moved': [
+            (old_members[email][0], team, member)
+            for email, (team, member) in new_members.items()
+            if email in old_members and old_members[email][0] != team
+        ],
+        'new_teams': [team for team in new if team not in old],
+        'emptied_teams': [team for team in old if team not in new],
+    }
+
+def describe_roster_changes(changes):
+    summary = (
+        f"🔄 Roster changes: {len(changes['added'])} added, {len(changes['removed'])} removed, "
+        f"{len(changes['moved'])} moved, {len(changes['new_teams'])} new team(s)"
+    )
+    if changes['emptied_teams']:
+        summary += f"\n⚠️ Now empty (channels kept): {', '.join(map(str, changes['emptied_teams']))}"
+    return summary
+
+async def apply_roster_changes(ctx, changes):
+    """Revoke, re-mint, re-email and re-role only the members that changed"""
+    guild = ctx.guild
+    state = guild_state(guild.id)
+    event_started = bool(state.invite_tracker) or bool(state.claim_landing) or any(
+        find_member_invite(guild.id, team, member.email)
+        or invite_key(guild.id, team, member.email) in state.joined_members
+        for team, member in changes['removed'] + [(old_team, member) for old_team, _, member in changes['moved']]
+    )
+
+    to_revoke = []
+    to_invite = list(changes['added'])
+    roles_moved = roles_removed = 0
+
+    for team, member in changes['removed']:
+        key = invite_key(guild.id, team, member.email)
+        if key in state.joined_members:
+            if await remove_team_role(guild, forget_member_joined(key), team):
+                roles_removed += 1
+        else:
+            to_revoke.append(find_member_invite(guild.id, team, member.email))
+            revoke_claim_code(key)
+
+    for old_team, new_team, member in changes['moved']:
+        old_key = invite_key(guild.id, old_team, member.email)
+        if old_key in state.joined_members:
+            member_id = forget_member_joined(old_key)
+            mark_member_joined({'guild_id': guild.id, 'team': new_team, 'member_email': member.email}, member_id)
+            discord_member = guild.get_member(member_id) if member_id else None
+            if discord_member:
+                await remove_team_role(guild, member_id, old_team)
+                if await assign_team_role(discord_member, new_team):
+                    roles_moved += 1
+            else:
+                log.warning(f"⚠️ {member.email} moved to {new_team} but their Discord account is unknown")
+        else:
+            to_revoke.append(find_member_invite(guild.id, old_team, member.email))
+            revoke_claim_code(old_key)
+            to_invite.append((new_team, member))
+
+    revoked = await revoke_member_invites(guild, to_revoke)
+
+    lines = [f"🔧 Revoked {revoked} invite(s), moved {roles_moved} role(s), removed {roles_removed} role(s)"]
+    if not event_started:
+        lines.append("ℹ️ No invites were sent yet, use `/create_invites` when ready.")
+        return "\n".join(lines)
+
+    # The event is running: invite the new and moved members right away
+    if ATTRIBUTION_MODE == 'claim':
+        minted = issue_claim_codes(guild.id, to_invite)
+        lines.append(f"🎟️ Issued {minted} claim code(s) for new or moved members")
+    else:
+        _, minted = await mint_member_invites(guild, ctx.channel, to_invite, ctx.progress)
+        lines.append(f"🔗 Minted {minted}/{len(to_invite)} invite(s) for new or moved members")
+    if minted and os.getenv('EMAIL_ADDRESS') and os.getenv('EMAIL_PASSWORD'):
+        sent = 0
+        queued, _ = queue_outbox(guild.id, to_invite)
+        async for _, _, ok in email_member_invites(queued):
+            sent += ok
+        lines.append(f"📧 Emailed {sent}/{len(queued)} of them")
+    return "\n".join(lines)
+
+@bot.hybrid_command(name="load", description="Load user data from a CSV/Excel file or attachment")
 @commands.has_any_role("Admin", "Moderator", "Leaders", "admin", "leader", "president") # Add other role names to your liking
-async def load_users(ctx, file_path: str):
+async def load_users(ctx, file_path: str = None, file: discord.Attachment = None):
+    return await submit_job(ctx, "load", load_roster_job, file_path, file)
+
+async def load_roster_job(ctx, file_path, file):
     try:
-        df = pd.read_excel(file_path)
-        required_columns = ['firstname', 'lastname', 'email', 'team']
-        if not all(col in df.columns for col in required_columns):
-            missing = [col for col in required_columns if col not in df.columns]
-            return await ctx.send(f"❌ Missing required columns: {', '.join(missing)}")
-        
-        bot.team_data = {}
-        for team, group in df.groupby('team'):
-            bot.team_data[team] = group.to_dict('records')
+        attachments = getattr(ctx.message, 'attachments', None) or []
+        attachment = file or (attachments[0] if attachments else None)
+        if attachment:
+            source, filename = io.BytesIO(await attachment.read()), attachment.filename
+        elif file_path:
+            source, filename = file_path, file_path
+        else:
+            return await ctx.send("❌ Attach a roster file or give a file path.")
+
+        # Parsing and validation run off the event loop
+        roster, errors = await asyncio.to_thread(load_roster_file, source, filename)
+        if errors:
+            await ctx.send(describe_roster_errors(errors))
+        if not roster:
+            return await ctx.send("❌ No valid users found in the file.")
+
+        # Only apply what changed since this server's previous roster. Diffing and saving a large
+        # roster take long enough to stall the gateway, so they run off the event loop as well
+        state = guild_state(ctx.guild.id)
+        changes = await asyncio.to_thread(diff_rosters, state.roster, roster)
+        state.roster = roster
+        await bot.store.replace_roster(ctx.guild.id, roster)
+        total_users = len(roster)
+        if changes['previous']:
+            await ctx.send(describe_roster_changes(changes))
             
-        # Create channels for all teams immediately
-        created_channels = []
-        for team_name in bot.team_data.keys():
-            success = await create_team_channels(ctx.guild, team_name)
-            if success:
-                created_channels.append(team_name)
+        # Create channels for new teams immediately, planned against the guild in one pass
+        teams_to_provision = dict.fromkeys(changes['new_teams'])
+        teams_to_provision.update(dict.fromkeys(team for team, _ in changes['added']))
+        teams_to_provision.update(dict.fromkeys(new_team for _, new_team, _ in changes['moved']))
+        async with provisioning_lock(ctx.guild):
+            plan = plan_team_provisioning(ctx.guild, teams_to_provision)
+            await ctx.progress.update(f"🏗️ Provisioning: {describe_plan(plan)}", force=True)
+            failed = await execute_provisioning_plan(ctx.guild, plan, ctx.progress)
+            await ctx.progress.update(f"🏗️ Provisioning done: {describe_plan(plan)}, {len(failed)} team(s) failed", force=True)
+        created_channels = [team_name for team_name in plan['teams'] if team_name not in failed]
+
+        if changes['previous']:
+            await ctx.send(await apply_roster_changes(ctx, changes))
         
         await ctx.send(
-            f"✅ Successfully loaded {len(df)} users "
-            f"across {len(bot.team_data)} teams!\n"
+            f"✅ Successfully loaded {total_users} users "
+            f"across {len(roster.teams)} teams!\n"
             f"Created channels for: {', '.join(created_channels) if created_channels else 'No new teams found'}"
         )
     except FileNotFoundError:
         await ctx.send("❌ File not found. Please check the path and try again.")
+    except RosterError as e:
+        await ctx.send(f"❌ {str(e)}")
     except Exception as e:
         await ctx.send(f"❌ Error loading file: {str(e)}")
 
+# ----------------------------
+# RATE LIMITING
+# ----------------------------
+class TokenBucket:
+    """Async token bucket: `rate` acquisitions per second with bursts up to `capacity`"""
+
+    def __init__(self, rate, capacity, name='bucket'):
+        self.name = name  # Label for the time spent waiting in /stats
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        started = time.monotonic()
+        waited = self._lock.locked()  # Queued behind callers that are sleeping for tokens
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                waited = True
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+        if waited:
+            bot.metrics.inc('ratelimit_wait_seconds_total', self.name, now - started)
+
+# ----------------------------
+# BULK PROVISIONING
+# ----------------------------
+# Roles (other than the team's own) that can access every team channel
+ADMIN_ROLES = ["Admin", "Moderator", "Organiser", "Formateur", "Supervisor", "Responsable", "President"]
+TEAMS_PER_CATEGORY = 4  # We're grouping each four teams (text + voice) in a bigger team Discord category
+PROVISION_CONCURRENCY = int(os.getenv('PROVISION_CONCURRENCY', 5))  # Parallel REST calls; discord.py queues on per-route buckets
+
+bot.provision_locks = {}  # {guild_id: asyncio.Lock} so concurrent plans don't create the same role or channel twice
+bot.category_slots = {}  # {guild_id: CategorySlots}
+
+class ProgressMessage:
+    """Status message edited at most once per interval, whatever the update rate"""
+
+    def __init__(self, message, interval=2.0, header=None):
+        self.message = message
+        self.interval = interval
+        self.header = header  # First line kept above every update
+        self.content = ""  # Latest status, even when its edit was skipped
+        self._last_edit = 0.0
+
+    async def update(self, content, force=False):
+        self.content = content
+        now = time.monotonic()
+        if not force and now - self._last_edit < self.interval:
+            return
+        self._last_edit = now
+        try:
+            await self.message.edit(content=f"{self.header}\n{content}" if self.header else content)
+        except discord.HTTPException:
+            pass
+
+def provisioning_lock(guild):
+    if guild.id not in bot.provision_locks:
+        bot.provision_locks[guild.id] = asyncio.Lock()
+    return bot.provision_locks[guild.id]
+
+def team_base_name(team_name):
+    return "".join(c for c in str(team_name) if c.isalnum() or c in " -_").strip()
+
+def team_role_name(team_name):
+    return team_base_name(team_name).title()
+
+def team_channel_names(team_name):
+    """(text, voice) channel names, text normalized the way Discord stores it"""
+    base_name = team_base_name(team_name).lower()
+    return f"{base_name.replace(' ', '-')}-chat", f"{base_name}-voice"
+
+def team_category_number(category_name):
+    """N for a 'TEAM N' category, None for anything else"""
+    prefix, _, number = category_name.partition(" ")
+    return int(number) if prefix == "TEAM" and number.isdigit() else None
+
+class CategorySlots:
+    """Free team slots in one guild's TEAM categories.
+
+    Built once from the guild index, then kept current by channel events and
+    by the provisioning steps. Reservations never await, so concurrent plans
+    can't hand out the same slot or number two new categories alike.
+    """
+
+    CAPACITY = TEAMS_PER_CATEGORY * 2  # Channels per category: one text and one voice per team
+
+    def __init__(self, index):
+        self.channels = {}  # {category_name: {channel_id}} channels already in the category
+        self.pending = {}  # {category_name: channels reserved but not created yet}
+        self.open = []  # Heap of (number, category_name) that may still have a free slot
+        self.next_number = 1
+        for category in index.all('category'):
+            self.add_category(category.name, category.channels)
+
+    def add_category(self, name, channels=()):
+        number = team_category_number(name)
+        if number is None or name in self.channels:
+            return
+        self.channels[name] = {channel.id for channel in channels}
+        self.pending[name] = 0
+        self.next_number = max(self.next_number, number + 1)
+        heapq.heappush(self.open, (number, name))
+
+    def remove_category(self, name):
+        # Its heap entry is skipped when it comes up
+        self.channels.pop(name, None)
+        self.pending.pop(name, None)
+
+    def free(self, name):
+        return (self.CAPACITY - len(self.channels[name]) - self.pending[name]) // 2
+
+    def allocate(self):
+        """Reserve a team slot in the lowest-numbered category with room, returns (category_name, is_new)"""
+        while self.open:
+            name = self.open[0][1]
+            if name in self.channels and self.free(name) > 0:
+                self.reserve(name, 2)
+                return name, False
+            heapq.heappop(self.open)
+        name = f"TEAM {self.next_number}"
+        self.add_category(name)
+        self.reserve(name, 2)
+        return name, True
+
+    def reserve(self, name, count):
+        if name in self.channels:
+            self.pending[name] += count
+
+    def commit(self, name, channel):
+        """A reserved channel was created"""
+        if name in self.channels:
+            self.pending[name] = max(self.pending[name] - 1, 0)
+            self.channels[name].add(channel.id)
+
+    def release(self, name, count=1):
+        """Reserved channels that won't be created give their room back"""
+        if name in self.channels:
+            self.pending[name] = max(self.pending[name] - count, 0)
+            self._reopen(name)
+
+    def channel_added(self, channel):
+        if channel.category and channel.category.name in self.channels:
+            self.channels[channel.category.name].add(channel.id)
+
+    def channel_removed(self, channel):
+        if channel.category and channel.category.name in self.channels:
+            self.channels[channel.category.name].discard(channel.id)
+            self._reopen(channel.category.name)
+
+    def _reopen(self, name):
+        if self.free(name) > 0:
+            heapq.heappush(self.open, (team_category_number(name), name))
+
+def category_slots(guild):
+    """Slot allocator for a guild, built on first use"""
+    slots = bot.category_slots.get(guild.id)
+    if slots is None:
+        slots = bot.category_slots[guild.id] = CategorySlots(guild_index(guild))
+    return slots
+
+def team_overwrites(guild, role, admin_roles):
+    """Channel permissions for a team: hidden from everyone but the team and admins"""
+    overwrites = {
+        guild.default_role: discord.PermissionOverwrite( # Default-role permissions
+            read_messages=False,
+            view_channel=False,
+            connect=False
+        ),
+        role: discord.PermissionOverwrite( # The assigned team roles permissions
+            read_messages=True,
+            view_channel=True,
+            send_messages=True,
+            connect=True,
+            speak=True
+        )
+    }
+    for admin_role in admin_roles:
+        # Admins as well as other roles present in ADMIN_ROLES can access the team channels
+        overwrites[admin_role] = discord.PermissionOverwrite(
+            read_messages=True,
+            view_channel=True,
+            send_messages=True,
+            manage_messages=True,
+            connect=True,
+            speak=True,
+            manage_channels=True
+        )
+    return overwrites
+
+def plan_team_provisioning(guild, team_names):
+    """Diff the desired teams against the guild in a single pass.
+
+    Returns {'teams', 'roles', 'categories', 'channels'} where roles/categories
+    are names to create and channels are (team, kind, name, category_name)
+    tuples. Teams take free slots of existing TEAM categories first, the
+    categories the rest need are planned up front and created in one batch.
+    """
+    index = guild_index(guild)
+    slots = category_slots(guild)
+    planned_roles = set()
+
+    plan = {'teams': [], 'roles': [], 'categories': [], 'channels': []}
+    for team_name in team_names:
+        plan['teams'].append(team_name)
+        role_name = team_role_name(team_name)
+        if not index.get('role', role_name) and role_name not in planned_roles:
+            planned_roles.add(role_name)
+            plan['roles'].append(role_name)
+
+        text_name, voice_name = team_channel_names(team_name)
+        existing_text = index.get('text', text_name)
+        existing_voice = index.get('voice', voice_name)
+        if existing_text and existing_voice:
+            continue
+
+        if existing_text or existing_voice:
+            # Keep the missing channel next to the one that already exists
+            sibling = existing_text or existing_voice
+            category_name = sibling.category.name if sibling.category else None
+            slots.reserve(category_name, 1)
+        else:
+            category_name, is_new = slots.allocate()
+            if is_new:
+                plan['categories'].append(category_name)
+
+        if not existing_text:
+            plan['channels'].append((team_name, 'text', text_name, category_name))
+        if not existing_voice:
+            plan['channels'].append((team_name, 'voice', voice_name, category_name))
+    return plan
+
+def describe_plan(plan):
+    return (
+        f"{len(plan['teams'])} teams, {len(plan['roles'])} roles, "
+        f"{len(plan['categories'])} categories, {len(plan['channels'])} channels to create"
+    )
+
+async def execute_provisioning_plan(guild, plan, progress=None):
+    """Run a provisioning plan with bounded concurrency, returns the set of failed teams"""
+    index = guild_index(guild)
+    slots = category_slots(guild)
+    role_names = plan['roles']
+    failed = set()
+
+    # Check the role hierarchy once instead of discovering it role by role
+    top_role = guild.me.top_role
+    if role_names and not guild.me.guild_permissions.manage_roles:
+        log.error(f"❌ Missing MANAGE_ROLES in {guild.name}, can't create {len(role_names)} team roles")
+        role_names = []
+    above_bot = [
+        role.name for role in (index.get('role', team_role_name(team_name)) for team_name in plan['teams'])
+        if role and role.position >= top_role.position
+    ]
+    if above_bot:
+        log.error(f"❌ Fix required: Drag @{top_role.name} above {', '.join('@' + name for name in above_bot)} in {guild.name}")
+
+    total = len(role_names) + len(plan['categories']) + len(plan['channels'])
+    done = 0
+    limiter = asyncio.Semaphore(PROVISION_CONCURRENCY)
+
+    async def step(coro):
+        nonlocal done
+        async with limiter:
+            try:
+                return await coro
+            except discord.HTTPException as e:
+                log.error(f"❌ Provisioning step failed in {guild.name}: {str(e)}")
+                return None
+            finally:
+                done += 1
+                if progress:
+                    await progress.update(f"🏗️ Provisioning... {done}/{total} steps")
+
+    async def create_role(role_name):
+        role = await guild.create_role(
+            name=role_name,
+            color=discord.Color.random(),
+            hoist=True,
+            mentionable=True,
+            reason=f"Auto-created for {role_name}"
+        )
+        index.add('role', role)
+        log.debug("✅ Created role: %s in %s", role_name, guild.name)
+        return role
+
+    async def position_roles(roles):
+        # New roles land at the bottom: move them all just below the bot's role in one request
+        top = guild.me.top_role.position
+        positions = {role: max(top - offset, 1) for offset, role in enumerate(roles, start=1)}
+        await guild.edit_role_positions(positions, reason="Team roles below the bot role")
+        log.info(f"🔀 Moved {len(roles)} team roles below @{guild.me.top_role.name} in {guild.name}")
+
+    async def create_category(category_name):
+        try:
+            category = await guild.create_category(category_name, reason=f"Team category {category_name}")
+        except discord.HTTPException:
+            slots.remove_category(category_name)
+            raise
+        index.add('category', category)
+        log.debug("✅ Created category %s in %s", category_name, guild.name)
+        return category
+
+    async def create_channel(team_name, kind, channel_name, category, overwrites):
+        create = guild.create_text_channel if kind == 'text' else guild.create_voice_channel
+        channel = await create(
+            channel_name,
+            overwrites=overwrites,
+            category=category,
+            reason=f"Team {team_name} {kind} channel"
+        )
+        index.add(kind, channel)
+        if category:
+            slots.commit(category.name, channel)
+        log.debug("✅ Created %s channel: %s", kind, channel_name)
+        return channel
+
+    # Roles and categories don't depend on each other, channels need both
+    created = await asyncio.gather(
+        *(step(create_role(name)) for name in role_names),
+        *(step(create_category(name)) for name in plan['categories'])
+    )
+    new_roles = [role for role in created[:len(role_names)] if role]
+    if new_roles:
+        try:
+            await position_roles(new_roles)
+        except discord.HTTPException as e:
+            log.warning(f"⚠️ Couldn't reposition team roles - ensure bot role is high enough: {str(e)}")
+    admin_roles = [role for role in (index.get('role', name) for name in ADMIN_ROLES) if role]
+
+    channel_steps = []
+    for team_name, kind, channel_name, category_name in plan['channels']:
+        role = index.get('role', team_role_name(team_name))
+        category = index.get('category', category_name) if category_name else None
+        if not role or (category_name and not category):
+            slots.release(category_name)
+            failed.add(team_name)
+            continue
+        overwrites = team_overwrites(guild, role, admin_roles)
+        channel_steps.append((
+            team_name, category_name, step(create_channel(team_name, kind, channel_name, category, overwrites))
+        ))
+
+    results = await asyncio.gather(*(coro for _, _, coro in channel_steps))
+    for (team_name, category_name, _), channel in zip(channel_steps, results):
+        if channel is None:
+            slots.release(category_name)
+            failed.add(team_name)
+    for role_name in plan['roles']:
+        if not index.get('role', role_name):
+            failed.update(t for t in plan['teams'] if team_role_name(t) == role_name)
+    return failed
+
+# ----------------------------
+# REPORTS AND EXPORTS
+# ----------------------------
+EXPORT_FORMATS = Literal['csv', 'xlsx']
+PAGE_LINES = 15
+FIND_LIMIT = 10  # Matches shown by /find
+
+def export_table(name, headers, rows, file_format='csv'):
+    """Write a report table into an in-memory CSV/XLSX attachment"""
+    buffer = io.BytesIO()
+    if file_format == 'xlsx':
+        import openpyxl
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet(name[:31])
+        sheet.append(headers)
+        for row in rows:
+            sheet.append(list(row))
+        workbook.save(buffer)
+    else:
+        text = io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')  # BOM so Excel detects UTF-8
+        writer = csv.writer(text)
+        writer.writerow(headers)
+        writer.writerows(rows)
+        text.flush()
+        text.detach()
+    buffer.seek(0)
+    return discord.File(buffer, filename=f"{name}.{file_format}")
+
+class PagedReportView(discord.ui.View):
+    """Summary embed plus a page of report lines, browsed with buttons"""
+
+    def __init__(self, author_id, summary, lines, per_page=PAGE_LINES):
+        super().__init__(timeout=600)
+        self.author_id = author_id
+        self.summary = summary
+        self.lines = lines
+        self.per_page = per_page
+        self.page = 0
+        self.pages = max(1, -(-len(lines) // per_page))
+        self._sync_buttons()
+
+    def embeds(self):
+        start = self.page * self.per_page
+        page = discord.Embed(
+            description="\n".join(self.lines[start:start + self.per_page])[:4096] or "Nothing to show",
+            color=self.summary.color
+        )
+        page.set_footer(text=f"Page {self.page + 1}/{self.pages}")
+        return [self.summary, page]
+
+    def _sync_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.pages - 1
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.author_id
+
+    async def _show(self, interaction, page):
+        self.page = page
+        self._sync_buttons()
+        await interaction.response.edit_message(embeds=self.embeds(), view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self._show(interaction, self.page + 1)
+
+async def send_report(ctx, summary, file, lines):
+    """Send a report as one message: summary, first page, full table attached"""
+    view = PagedReportView(ctx.author.id, summary, lines)
+    await ctx.send(embeds=view.embeds(), file=file, view=view if view.pages > 1 else None)
+
+# ----------------------------
+# BACKGROUND JOBS
+# ----------------------------
+JOB_HISTORY = 50  # Finished jobs kept around for /jobs
+JOB_ICONS = {'queued': "🕒", 'running': "⏳", 'done': "✅", 'failed': "❌", 'cancelled': "🛑"}
+
+bot.jobs = {}  # {job_id: Job} queued, running and the most recent finished jobs
+bot.job_queues = {}  # {guild_id: asyncio.Queue of Job}
+bot.job_workers = {}  # {guild_id: asyncio.Task}
+bot.job_ids = itertools.count(1)
+
+class JobContext:
+    """Context handed to a job: replies go to the channel, since the interaction may expire mid-job"""
+
+    def __init__(self, ctx, job):
+        self.guild = ctx.guild
+        self.channel = ctx.channel
+        self.author = ctx.author
+        self.message = ctx.message
+        self.job = job
+
+    @property
+    def progress(self):
+        """The job's status message, throttled like every ProgressMessage"""
+        return self.job.progress
+
+    async def defer(self):
+        pass
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+class Job:
+    """A long admin operation, run in the background after its guild's earlier jobs"""
+
+    def __init__(self, ctx, name, func, args):
+        self.id = next(bot.job_ids)
+        self.name = name
+        self.ctx = JobContext(ctx, self)
+        self.func = func
+        self.args = args
+        self.state = 'queued'
+        self.created = time.monotonic()
+        self.started = self.ended = None
+        self.task = None
+        self.progress = None
+        self.finished = asyncio.Event()
+
+    @property
+    def title(self):
+        return f"{JOB_ICONS[self.state]} Job #{self.id} `{self.name}`"
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.ended or time.monotonic()) - self.started
+
+    async def wait(self):
+        await self.finished.wait()
+
+async def submit_job(ctx, name, func, *args):
+    """Queue func(job_ctx, *args) behind the guild's other jobs and acknowledge right away"""
+    job = Job(ctx, name, func, args)
+    ahead = sum(
+        1 for other in bot.jobs.values()
+        if other.ctx.guild.id == ctx.guild.id and other.state in ('queued', 'running')
+    )
+    bot.jobs[job.id] = job
+
+    guild_id = ctx.guild.id
+    if guild_id not in bot.job_queues:
+        bot.job_queues[guild_id] = asyncio.Queue()
+    bot.job_queues[guild_id].put_nowait(job)
+    worker = bot.job_workers.get(guild_id)
+    if worker is None or worker.done():
+        bot.job_workers[guild_id] = asyncio.create_task(job_worker(guild_id))
+
+    position = f" behind {ahead} other job(s)" if ahead else ""
+    await ctx.send(f"🧵 Job #{job.id} `{name}` queued{position}. Follow it with `/jobs`, stop it with `/cancel {job.id}`.")
+    return job
+
+async def job_worker(guild_id):
+    """Run a guild's jobs one at a time; other guilds have their own worker"""
+    job_queue = bot.job_queues[guild_id]
+    while True:
+        job = await job_queue.get()
+        if job.state == 'queued':
+            await run_job(job)
+
+async def run_job(job):
+    job.state = 'running'
+    log_context.set({'guild': job.ctx.guild.id, 'job': job.id})  # Copied into the job task below
+    job.started = time.monotonic()
+    try:
+        job.progress = ProgressMessage(await job.ctx.send(f"{job.title} started"), header=job.title)
+        job.task = asyncio.create_task(job.func(job.ctx, *job.args))
+        await asyncio.wait([job.task])  # Doesn't raise, so cancelling the job leaves the worker running
+        if job.task.cancelled():
+            job.state = 'cancelled'
+        elif job.task.exception():
+            job.state = 'failed'
+            error = job.task.exception()
+            log.error(f"❌ Job #{job.id} {job.name} failed: {str(error)}", exc_info=error)
+            await job.ctx.send(f"❌ Job #{job.id} `{job.name}` failed: {str(error)}")
+        else:
+            job.state = 'done'
+    except discord.HTTPException as e:
+        job.state = 'failed'
+        log.error(f"❌ Couldn't start job #{job.id} {job.name}: {str(e)}")
+    finally:
+        job.ended = time.monotonic()
+        bot.metrics.observe('job_seconds', job.name, job.elapsed())
+        if job.progress:
+            job.progress.header = f"{job.title} {job.state} in {job.elapsed():.1f}s"
+            await job.progress.update(job.progress.content, force=True)
+        job.finished.set()
+        prune_jobs()
+
+def prune_jobs():
+    finished = [job_id for job_id, job in bot.jobs.items() if job.finished.is_set()]
+    for job_id in finished[:-JOB_HISTORY]:
+        del bot.jobs[job_id]
+
+@bot.hybrid_command(name="jobs", description="List background jobs and their progress")
+@commands.has_any_role("Admin", "Moderator", "Leaders", "admin", "leader", "president")
+async def list_jobs(ctx):
+    guild_jobs = [job for job in bot.jobs.values() if job.ctx.guild.id == ctx.guild.id]
+    if not guild_jobs:
+        return await ctx.send("No jobs yet.")
+
+    embed = discord.Embed(title="🧵 Background Jobs", color=discord.Color.blue())
+    for job in guild_jobs[-20:]:
+        status = job.progress.content if job.progress and job.progress.content else job.state
+        embed.add_field(
+            name=f"{job.title} · {job.elapsed():.0f}s",
+            value=status[:1024],
+            inline=False
+        )
+    await ctx.send(embed=embed)
+
+@bot.hybrid_command(name="cancel", description="Cancel a queued or running background job")
+@commands.has_any_role("Admin", "Moderator", "Leaders", "admin", "leader", "president")
+async def cancel_job(ctx, job_id: int):
+    job = bot.jobs.get(job_id)
+    if not job or job.ctx.guild.id != ctx.guild.id:
+        return await ctx.send(f"❌ No job #{job_id} in this server.")
+    if job.state == 'queued':
+        job.state = 'cancelled'
+        job.finished.set()
+    elif job.state == 'running' and job.task:
+        job.task.cancel()
+    else:
+        return await ctx.send(f"ℹ️ Job #{job_id} already {job.state}.")
+    await ctx.send(f"🛑 Cancelling job #{job_id} `{job.name}`.")
+
 # ----------------------------
 # INVITE MANAGEMENT SYSTEM
 # ----------------------------
+INVITE_RATE = float(os.getenv('INVITE_RATE', 1.0))  # Invites minted per second on average
+INVITE_BURST = int(os.getenv('INVITE_BURST', 5))  # Invites that may be minted back to back before pacing kicks in
+
 @bot.hybrid_command(name="create_invites", description="Create team-specific invites")
 @commands.has_any_role("Admin", "Moderator", "Leaders", "admin", "leader", "president")
-async def create_invites(ctx):
-    # Immediately acknowledge the interaction
-    await ctx.defer()
-    
-    if not bot.team_data:
-        print("❌ No team data loaded! Use `/load` first.")
+async def create_invites(ctx, file_format: EXPORT_FORMATS = 'csv'):
+    job_func = create_claims_job if ATTRIBUTION_MODE == 'claim' else create_invites_job
+    return await submit_job(ctx, "create_invites", job_func, file_format)
+
+async def create_invites_job(ctx, file_format):
+    state = guild_state(ctx.guild.id)
+    if not state.roster:
+        log.error("❌ No team data loaded! Use `/load` first.")
         return await ctx.send("❌ No team data loaded! Use `/load` first.")
     
-    bot.invite_links = {}
-    results = []
-    
     try:
-        for team_name, members in bot.team_data.items():
-            # Create one invite per team member.
+        # One snapshot tells us which previously minted invites are still usable
+        live_codes = None  # Without MANAGE_GUILD we can't check, so trust what we minted
+        if ctx.guild.me.guild_permissions.manage_guild:
+            live_codes = {invite.code for invite in await ctx.guild.invites()}
+
+        to_mint = []
+        kept = joined = 0
+        for team_name, members in state.roster.items():
             for member in members:
-                try:
-                    invite = await ctx.channel.create_invite(
-                        max_uses=1, # You can choose how many times an invite link can be used by modifying max_uses.
-                        unique=True,
-                        reason=f"Team:{team_name} Member:{member['email']}",
-                        max_age=0 # here you can choose for how long the invite link is valid, Discord allows ]0, a week (in secs)] U (infinity which takes the value of "0")
-                    )
-                    
-                    bot.invite_links[invite.url] = {
-                        'team': team_name,
-                        'member_email': member['email'],
-                        'guild_id': ctx.guild.id
-                    }
-                    bot.invite_tracker[invite.url] = invite.uses
-                    results.append(f"• {team_name} ({member['email']}): {invite.url}")
-                    print(f"✅ Created invite for {team_name} member {member['email']}: {invite.url}")
-                    
-                except discord.HTTPException as e:
-                    results.append(f"• {team_name}: ❌ Failed ({str(e)})")
-                    print(f"❌ Failed to create invites for team {team_name}: {str(e)}")
+                key = invite_key(ctx.guild.id, team_name, member.email)
+                if key in state.joined_members:
+                    joined += 1
                     continue
-        
-        message = "**Generated Member Invites:**\n" + "\n".join(results)
-        if len(message) > 2000:
-            chunks = [message[i:i+2000] for i in range(0, len(message), 2000)]
-            for chunk in chunks:
-                await ctx.send(chunk)
-        else:
-            await ctx.send(message)
+                existing_url = state.invite_index.get(key)
+                if existing_url and (live_codes is None or invite_code(existing_url) in live_codes):
+                    kept += 1
+                    continue
+                if existing_url:
+                    unregister_invite(ctx.guild.id, existing_url)  # Expired or revoked, replace it
+                to_mint.append((team_name, member))
+
+        await ctx.progress.update(
+            f"🔗 Minting {len(to_mint)} invites ({kept} still valid, {joined} already joined)...", force=True
+        )
+        failures, minted = await mint_member_invites(ctx.guild, ctx.channel, to_mint, ctx.progress)
+        await ctx.progress.update(f"🔗 Minted {minted}/{len(to_mint)} invites ({kept} still valid, {joined} already joined)", force=True)
+
+        minted_emails = {member.email for _, member in to_mint if member.email not in failures}
+        rows = []
+        for team_name, members in state.roster.items():
+            for member in members:
+                key = invite_key(ctx.guild.id, team_name, member.email)
+                if key in state.joined_members:
+                    status = "joined"
+                elif member.email in failures:
+                    status = f"failed: {failures[member.email]}"
+                else:
+                    status = "new" if member.email in minted_emails else "existing"
+                rows.append((team_name, member.email, state.invite_index.get(key, ''), status))
+
+        embed = discord.Embed(title="🔗 Generated Member Invites", color=discord.Color.green())
+        embed.add_field(name="Minted", value=str(minted))
+        embed.add_field(name="Still valid", value=str(kept))
+        embed.add_field(name="Already joined", value=str(joined))
+        embed.add_field(name="Failed", value=str(len(failures)))
+        await send_report(
+            ctx, embed,
+            export_table("invites", ["team", "email", "invite_url", "status"], rows, file_format),
+            [f"{team} · {email} · {url or status}" for team, email, url, status in rows]
+        )
             
     except Exception as e:
         await ctx.send(f"❌ Error creating invites: {str(e)}")
-        print(f"❌ Global error in create_invites: {str(e)}")
+        log.error(f"❌ Global error in create_invites: {str(e)}")
+
+async def mint_member_invites(guild, channel, recipients, progress=None):
+    """Mint one single-use invite per (team_name, member), paced by a token bucket.
+
+    Each invite is registered (and persisted) as soon as it exists so an
+    interrupted run can resume. Returns ({email: error} for failures, number minted).
+    """
+    bucket = TokenBucket(INVITE_RATE, INVITE_BURST, name='invites')
+    failures = {}
+    minted = 0
+
+    async def mint(team_name, member):
+        nonlocal minted
+        await bucket.acquire()
+        try:
+            invite = await channel.create_invite(
+                max_uses=1, # You can choose how many times an invite link can be used by modifying max_uses.
+                unique=True,
+                reason=f"Team:{team_name} Member:{member.email}",
+                max_age=0 # here you can choose for how long the invite link is valid, Discord allows ]0, a week (in secs)] U (infinity which takes the value of "0")
+            )
+        except discord.HTTPException as e:
+            failures[member.email] = str(e)
+            log.error(f"❌ Failed to create invite for {team_name} member {member.email}: {str(e)}")
+            return
+
+        # Checkpoint right away so a re-run skips this member. A snapshot fetched before this
+        # invite existed must not see it tracked, or the diff would count it as used
+        async with snapshot_lock(guild.id):
+            register_invite(invite.url, {
+                'team': team_name,
+                'member_email': member.email,
+                'guild_id': guild.id
+            })
+            track_invite(guild.id, invite.code, invite.uses)
+        log.debug("✅ Created invite for %s member %s: %s", team_name, member.email, invite.url)
+        minted += 1
+        if progress:
+            await progress.update(f"🔗 Minting invites... {minted}/{len(recipients)}")
+
+    await asyncio.gather(*(mint(team_name, member) for team_name, member in recipients))
+    return failures, minted
+
+async def revoke_member_invites(guild, invite_urls):
+    """Delete bot invites on Discord and forget them, returns how many were revoked"""
+    invite_urls = [url for url in invite_urls if url]
+    if not invite_urls:
+        return 0
+    live = {}
+    if guild.me.guild_permissions.manage_guild:
+        live = {invite.code: invite for invite in await guild.invites()}
+
+    revoked = 0
+    for invite_url in invite_urls:
+        invite = live.get(invite_code(invite_url))
+        if invite:
+            try:
+                await invite.delete(reason="Member removed from roster")
+                revoked += 1
+            except discord.HTTPException as e:
+                log.warning(f"⚠️ Couldn't revoke {invite_url}: {str(e)}")
+        unregister_invite(guild.id, invite_url)
+    return revoked
+
+# ----------------------------
+# IMPROVED EMAIL SYSTEM
+# ----------------------------
+class SendSkipped(asyncio.CancelledError):
+    """Cancelled before the message reached an SMTP session, so it was never sent"""
+
+class MailDispatcher:
+    """Pool of authenticated SMTP sessions shared by all outgoing emails.
+
+    Sessions are opened lazily, reused across messages and driven from a
+    dedicated thread pool so the event loop never blocks on SMTP I/O.
+    """
+
+    def __init__(self, pool_size=4, max_per_session=50):
+        self.pool_size = max(1, pool_size)
+        self.max_per_session = max_per_session  # Most providers drop sessions after a number of messages
+        self._idle = queue.LifoQueue()  # (server, sent_count), most recently used first
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="smtp")
+        self.slots = asyncio.Semaphore(self.pool_size)  # Held by senders while a thread is free for their message
+
+    def _connect(self):
+        import smtplib  # Mail stack is only loaded once something is sent
+        smtp_server = os.getenv('SMTP_SERVER')
+        smtp_port = int(os.getenv('SMTP_PORT', 587))
+
+        # Handle different SMTP connection types
+        if smtp_port == 465:
+            server = smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=10)
+        else:
+            server = smtplib.SMTP(smtp_server, smtp_port, timeout=10)
+            if os.getenv('SMTP_STARTTLS', 'true').lower() != 'false':  # Plain relays (local MTA, test sinks) opt out
+                server.starttls()
+        server.login(os.getenv('EMAIL_ADDRESS'), os.getenv('EMAIL_PASSWORD'))
+        return server
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect(), 0
+
+    def _release(self, server, sent_count):
+        if sent_count >= self.max_per_session:
+            self._quit(server)
+        else:
+            self._idle.put((server, sent_count))
+
+    @staticmethod
+    def _quit(server):
+        try:
+            server.quit()
+        except Exception:
+            pass
+
+    def _send_blocking(self, msg):
+        import smtplib
+        server, sent_count = self._acquire()
+        try:
+            server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # Idle session was dropped by the server, retry once on a fresh one
+            server, sent_count = self._connect(), 0
+            server.send_message(msg)
+        except Exception:
+            self._quit(server)
+            raise
+        self._release(server, sent_count + 1)
+
+    async def send(self, msg):
+        """Send a message on a pooled session without blocking the event loop"""
+        future = self._executor.submit(self._send_blocking, msg)
+        try:
+            with bot.metrics.timer('smtp_send_seconds'):
+                await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if future.cancel():
+                raise SendSkipped() from None  # Still queued behind other sends, it never will be sent
+            raise
+        bot.metrics.mark('emails_sent')
 
-# ----------------------------
-# IMPROVED EMAIL SYSTEM
-# ----------------------------
-async def send_team_invite(user: dict, invite_url: str):
-    try:
-        if not all(k in user for k in ['email', 'firstname', 'team']):
-            print(f"❌ Missing user data for {user.get('email', 'unknown')}")
-            raise ValueError("Missing user data")
-            
-        # Validate email format properly.
-        if '@' not in user['email'] or '.' not in user['email'].split('@')[-1]:
-            print(f"❌ Invalid email format: {user['email']}")
-            raise ValueError(f"Invalid email: {user['email']}")
-            
-        msg = MIMEMultipart()
-        msg['From'] = os.getenv('EMAIL_ADDRESS')
-        msg['To'] = user['email']
-        msg['Subject'] = "insert the subject of your message"
-        body = f"""<html>
+    def _close_idle_blocking(self):
+        while True:
+            try:
+                server, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._quit(server)
+
+    async def close_idle(self):
+        """Log out of every idle session (they would time out server-side anyway)"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._close_idle_blocking)
+
+bot.mailer = MailDispatcher(pool_size=int(os.getenv('SMTP_POOL_SIZE', 4)))
+
+EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', 5))  # Tries per recipient before a transient error counts as failed
+EMAIL_RETRY_BASE = float(os.getenv('EMAIL_RETRY_BASE', 2))  # Seconds before the first retry, doubled after every attempt
+EMAIL_RETRY_CAP = 300  # Longest pause between two attempts
+
+async def send_team_invite(user: RosterMember, invite_url: str, claim_code: str = None):
+    """Email a member their invite, raising on bad user data or SMTP errors"""
+    if not (user.email and user.firstname and user.team):
+        raise ValueError("Missing user data")
+
+    # Validate email format properly.
+    if '@' not in user.email or '.' not in user.email.split('@')[-1]:
+        raise ValueError(f"Invalid email: {user.email}")
+
+    claim_paragraph = ""
+    if claim_code:
+        claim_paragraph = (
+            f"<p>🎟️ <strong>Claim code :</strong> {format_claim_code(claim_code)}<br>"
+            f"after joining, press \"Claim my team\" in #{CLAIM_CHANNEL} and enter this code</p>"
+        )
+
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+    msg = MIMEMultipart()
+    msg['From'] = os.getenv('EMAIL_ADDRESS')
+    msg['To'] = user.email
+    msg['Subject'] = "insert the subject of your message"
+    body = f"""<html>
 <body>
-<p><strong>{user['team']},</strong><br>
+<p><strong>{user.team},</strong><br>
 Dear participants,<br>
 <p> the rest of your message could be here, you could modify it as you like, just write normal html</p>
 
 <p>🔗 <strong>Discord link :</strong><br>
 {invite_url}</p>
+{claim_paragraph}
 <p>again, just write normal html</p>
 <p><strong>signature</strong></p>
 </body>
 </html>
 """
-        
-        msg.attach(MIMEText(body, 'html'))
-        
-        # Handle different SMTP connection types
-        smtp_server = os.getenv('SMTP_SERVER')
-        smtp_port = int(os.getenv('SMTP_PORT', 587))
-        
-        if smtp_port == 465:
-            with smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=10) as server:
-                server.login(os.getenv('EMAIL_ADDRESS'), os.getenv('EMAIL_PASSWORD'))
-                server.send_message(msg)
-        else:
-            with smtplib.SMTP(smtp_server, smtp_port, timeout=10) as server:
-                server.starttls()
-                server.login(os.getenv('EMAIL_ADDRESS'), os.getenv('EMAIL_PASSWORD'))
-                server.send_message(msg)
-                
-        print(f"✅ Email successfully sent to {user['email']}")
-        return True
-        
-    except smtplib.SMTPException as e:
-        print(f"❌ SMTP Error for {user['email']}: {str(e)}")
-        return False
-    except Exception as e:
-        print(f"❌ general error for {user['email']}: {str(e)}")
-        return False
+
+    msg.attach(MIMEText(body, 'html'))
+
+    await bot.mailer.send(msg)
+
+def is_transient_email_error(error):
+    """4xx replies, dropped connections and timeouts are worth retrying, anything else is final"""
+    import smtplib
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (smtplib.SMTPServerDisconnected, OSError))
+
+def set_outbox_status(key, status, error=None):
+    entry = guild_state(key[0]).outbox[key]
+    entry['status'] = status
+    entry['error'] = error
+    bot.store.save_outbox(key, entry)
+
+def queue_outbox(guild_id, recipients, only_failed=False):
+    """Stage (team_name, user) recipients in the outbox.
+
+    Returns ([(team_name, user, key)] to deliver, counts of those skipped).
+    Rows already sent with their current invite are never sent again, and
+    failed rows are only picked up when `only_failed` is set.
+    """
+    state = guild_state(guild_id)
+    queued = []
+    skipped = {'sent': 0, 'failed': 0, 'no_invite': 0, 'in_progress': 0}
+    for team_name, user in recipients:
+        key = invite_key(guild_id, team_name, user.email)
+        invite_url = member_invite_url(key)
+        if not invite_url:
+            log.warning(f"⚠️ No invite found for {user.email} in team {team_name}")
+            skipped['no_invite'] += 1
+            continue
+        if key in state.outbox_inflight:
+            skipped['in_progress'] += 1
+            continue
+
+        entry = state.outbox.get(key)
+        same_invite = entry is not None and entry['invite_url'] == invite_url
+        if same_invite and entry['status'] == 'sent':
+            skipped['sent'] += 1
+            continue
+        failed = same_invite and entry['status'] == 'failed'
+        if failed != only_failed:
+            skipped['failed'] += failed
+            continue
+
+        if not same_invite or failed:
+            # A new (or re-minted) invite, or a failure being retried: start a fresh attempt budget
+            state.outbox[key] = {'invite_url': invite_url, 'status': 'pending', 'attempts': 0, 'error': None}
+            bot.store.save_outbox(key, state.outbox[key])
+        queued.append((team_name, user, key))
+    return queued, skipped
+
+async def deliver_invite(user, key):
+    """Send one outbox row, retrying transient SMTP errors with exponential backoff"""
+    state = guild_state(key[0])
+    entry = state.outbox[key]
+    state.outbox_inflight.add(key)
+    try:
+        while True:
+            # Rows waiting for a free SMTP session stay 'pending', so a crash only leaves the ones really on the wire in doubt
+            async with bot.mailer.slots:
+                entry['attempts'] += 1
+                set_outbox_status(key, 'sending')
+                try:
+                    await send_team_invite(user, entry['invite_url'], state.member_claims.get(key))
+                except SendSkipped:
+                    entry['attempts'] -= 1
+                    set_outbox_status(key, 'pending', entry['error'])  # Nothing went out, the next run sends it
+                    raise
+                except asyncio.CancelledError:
+                    set_outbox_status(key, 'failed', "Cancelled mid-send, may have been delivered")
+                    raise
+                except Exception as e:
+                    import smtplib
+                    if isinstance(e, smtplib.SMTPResponseException):
+                        reply = e.smtp_error.decode(errors='replace') if isinstance(e.smtp_error, bytes) else e.smtp_error
+                        error = f"SMTP {e.smtp_code}: {reply}"
+                    else:
+                        error = f"{type(e).__name__}: {e}"
+                    transient = is_transient_email_error(e)
+                else:
+                    error = None
+            if error is None:
+                set_outbox_status(key, 'sent')
+                log.debug("✅ Email successfully sent to %s", user.email)
+                return True
+            if transient and entry['attempts'] < EMAIL_MAX_ATTEMPTS:
+                delay = min(EMAIL_RETRY_CAP, EMAIL_RETRY_BASE * 2 ** (entry['attempts'] - 1))
+                delay *= random.uniform(0.5, 1)  # Jitter so throttled sends don't retry in lockstep
+                set_outbox_status(key, 'pending', error)
+                log.warning(f"⏳ {error} for {user.email}, retry {entry['attempts']}/{EMAIL_MAX_ATTEMPTS - 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)  # Outside the slot, a backing-off row doesn't hold up the others
+                continue
+            set_outbox_status(key, 'failed', error)
+            bot.metrics.inc('emails_failed_total')
+            log.error(f"❌ Failed to email {user.email} after {entry['attempts']} attempt(s): {error}")
+            return False
+    finally:
+        state.outbox_inflight.discard(key)
+
+async def email_member_invites(queued):
+    """Deliver staged outbox rows, yielding (team_name, user, sent) as each one settles"""
+    async def send_one(team_name, user, key):
+        return team_name, user, await deliver_invite(user, key)
+
+    # Sends run concurrently, bounded by the mailer's session pool
+    sends = [asyncio.create_task(send_one(*row)) for row in queued]
+    try:
+        for next_result in asyncio.as_completed(sends):
+            yield await next_result
+    finally:
+        # Cancelling the job lands here, stop every send that hasn't settled and let it record its status
+        for send in sends:
+            send.cancel()
+        await asyncio.gather(*sends, return_exceptions=True)
+        await bot.mailer.close_idle()
 
 @bot.hybrid_command(name="send_invites", description="Email invites to all users")
 @commands.has_any_role("Admin", "Moderator", "Leaders", "admin", "leader", "president")
-async def send_invites(ctx):
-    if not bot.invite_links:
-        print("❌ No invites created! Use `/create_invites` first.")
+async def send_invites(ctx, file_format: EXPORT_FORMATS = 'csv'):
+    """Email every member their invite, resuming after whoever was already emailed"""
+    return await submit_job(ctx, "send_invites", deliver_outbox, file_format)
+
+@bot.hybrid_command(name="resend_failed", description="Retry only the invite emails that failed")
+@commands.has_any_role("Admin", "Moderator", "Leaders", "admin", "leader", "president")
+async def resend_failed(ctx, file_format: EXPORT_FORMATS = 'csv'):
+    return await submit_job(ctx, "resend_failed", deliver_outbox, file_format, True)
+
+async def deliver_outbox(ctx, file_format, only_failed=False):
+    state = guild_state(ctx.guild.id)
+    if not state.invite_links and not state.claim_codes:
+        log.error("❌ No invites created! Use `/create_invites` first.")
         return await ctx.send("❌ No invites created! Use `/create_invites` first.")
-    if not bot.team_data:
-        print("❌ No team data loaded! Use `/load` first.")
+    if not state.roster:
+        log.error("❌ No team data loaded! Use `/load` first.")
         return await ctx.send("❌ No team data loaded! Use `/load` first.")
     
     # Verify email configuration.
     if not os.getenv('EMAIL_ADDRESS') or not os.getenv('EMAIL_PASSWORD'):
-        print("❌ Email credentials not configured in .env file")
+        log.error("❌ Email credentials not configured in .env file")
         return await ctx.send("❌ email functionality is disabled - check server logs")
 
-    total_emails = sum(len(users) for users in bot.team_data.values())
-    if total_emails == 0:
-        print("❌ No users found in team data.")
+    recipients = [(team_name, user) for team_name, users in state.roster.items() for user in users]
+    if not recipients:
+        log.error("❌ No users found in team data.")
         return await ctx.send("❌ No users found.")
-    
-    print(f"📧 starting to send {total_emails} emails...")
-    progress_msg = await ctx.send("🔄 starting email sends... (0%)")
+
+    queued, skipped = queue_outbox(ctx.guild.id, recipients, only_failed)
+    skipped_text = (
+        f"{skipped['sent']} already emailed, {skipped['failed']} failed earlier, "
+        f"{skipped['no_invite']} without invite, {skipped['in_progress']} being sent elsewhere"
+    )
+    if not queued:
+        hint = " Use `/resend_failed` to retry the failures." if skipped['failed'] else ""
+        return await ctx.send(f"✅ Nothing to send ({skipped_text}).{hint}")
+
+    log.info(f"📧 starting to send {len(queued)} emails...")
+    await ctx.progress.update(f"🔄 Sending {len(queued)} emails ({skipped_text})...", force=True)
     success = failures = 0
     failed_emails = []
-    
-    for team_name, users in bot.team_data.items():
-        for user in users:
-            # Find the specific invite for this user.
-            invite_url = next(
-                (url for url, data in bot.invite_links.items() 
-                 if data['team'] == team_name 
-                 and data['member_email'] == user['email']
-                 and data['guild_id'] == ctx.guild.id),
-                None
-            )
-            if not invite_url:
-                print(f"⚠️ No invite found for {user['email']} in team {team_name}")
-                continue
-                
-            processed = success + failures + 1
-            progress = int((processed / total_emails) * 100)
-            
-            if await send_team_invite(user, invite_url):
-                success += 1
-                print(f"✅ Email sent to {user['email']} ({team_name})")
-            else:
-                failures += 1
-                failed_emails.append(user['email'])
-                print(f"❌ failed to send email to {user['email']} ({team_name})")
-                
-            if progress % 10 == 0 or processed == total_emails:
-                await progress_msg.edit(content=f"🔄 Sending... ({progress}%)")
-                print(f"📊 Email progress: {progress}%")
-    
-    report = [
-        f"📬 Email sending complete!",
-        f"✅ Success: {success}",
-        f"❌ Failed: {failures}"
-    ]
-    
-    if failures > 0:
-        report.append("\nFailed recipients (first 5):")
-        report.extend(failed_emails[:5])
-        if len(failed_emails) > 5:
-            report.append(f"(+{len(failed_emails)-5} more)")
-    
-    await progress_msg.delete()
-    full_report = "\n".join(report)
-    print(f"📝 final email report:\n{full_report}")
-    
-    if len(full_report) > 2000:
-        chunks = [full_report[i:i+2000] for i in range(0, len(full_report), 2000)]
-        for chunk in chunks:
-            await ctx.send(chunk)
-    else:
-        await ctx.send(full_report)
+    async for team_name, user, sent in email_member_invites(queued):
+        if sent:
+            success += 1
+        else:
+            failures += 1
+            entry = state.outbox[invite_key(ctx.guild.id, team_name, user.email)]
+            failed_emails.append((team_name, user.email, entry['attempts'], entry['error']))
+        processed = success + failures
+        await ctx.progress.update(f"🔄 Sending... {processed}/{len(queued)} ({processed * 100 // len(queued)}%)")
+
+    await ctx.progress.update(f"📧 Sent {success}/{len(queued)} emails, {failures} failed", force=True)
+    log.info(f"📝 final email report: {success} sent, {failures} failed")
+
+    embed = discord.Embed(
+        title="📬 Email sending complete!",
+        color=discord.Color.green() if not failures else discord.Color.orange(),
+        description=f"Skipped: {skipped_text}"
+    )
+    embed.add_field(name="✅ Success", value=str(success))
+    embed.add_field(name="❌ Failed", value=str(failures))
+    if not failures:
+        return await ctx.send(embed=embed)
+    embed.set_footer(text="Use /resend_failed to retry only the failed emails")
+    await send_report(
+        ctx, embed,
+        export_table("failed_emails", ["team", "email", "attempts", "error"], failed_emails, file_format),
+        [f"{team} · {email} · {error}" for team, email, _, error in failed_emails]
+    )
 
 # ----------------------------
 # ROLE ASSIGNMENT SYSTEM
 # ----------------------------
-@bot.event
+JOIN_RETRY_DELAY = float(os.getenv('JOIN_RETRY_DELAY', 2))  # Seconds before re-checking a join whose invite use hasn't shown up
+JOIN_MATCH_TIMEOUT = float(os.getenv('JOIN_MATCH_TIMEOUT', 30))  # Seconds a join is retried before admins are asked to step in
+UNCLAIMED_INVITE_TTL = 120  # Seconds a consumed invite waits for its member's join event
+
+bot.join_queues = {}  # {guild_id: asyncio.Queue of joined members}
+bot.join_workers = {}  # {guild_id: asyncio.Task}
+bot.welcome_tasks = set()  # Role, channel and welcome work still running, referenced so it isn't garbage collected
+
+@metered_event
 async def on_member_join(member):
-    try:
-        await asyncio.sleep(5)
-        guild = member.guild
-        
-        if not guild.me.guild_permissions.manage_guild:
-            print(f"❌ Missing MANAGE_GUILD permission in {guild.name}")
-            return
+    # Joins are queued per guild: a lone join is snapshotted right away, joins that arrive
+    # while a snapshot is in flight share the next one
+    guild_id = member.guild.id
+    log_context.set({'guild': guild_id})
+    if ATTRIBUTION_MODE == 'claim':
+        return  # Members identify themselves with their claim code, no invite snapshot needed
+    guild_state(guild_id).join_started[member.id] = time.monotonic()
+    if guild_id not in bot.join_queues:
+        bot.join_queues[guild_id] = asyncio.Queue()
+    bot.join_queues[guild_id].put_nowait(member)
 
-        # Get current invites.
-        current_invites = await guild.invites()
-        used_invite = None
-        
-        # Check which invite is missing (was used)
-        for invite_url, uses in bot.invite_tracker.items():
-            # Find if this tracked invite still exists
-            invite_still_exists = any(invite.url == invite_url for invite in current_invites)
-            
-            # If invite no longer exists and was created by bot, it was used
-            if not invite_still_exists and invite_url in bot.invite_links:
-                print(f"🔍 Detected used invite: {invite_url} (no longer exists)")
-                used_invite_url = invite_url
-                # Remove from tracker since it's been used.
-                bot.invite_tracker.pop(invite_url, None)
-                
-                # Get team from our stored data
-                invite_data = bot.invite_links.get(invite_url)
-                if invite_data and invite_data['guild_id'] == guild.id:
-                    team_name = invite_data['team']
-                    print(f"🎉 {member.name} joined using invite for {team_name}")
-                    
-                    # Assign role with retry logic
-                    success = await assign_team_role(member, team_name)
-                    if success:
-                        # Create channels if they don't exist
-                        await create_team_channels(guild, team_name)
-                        
-                        # Send welcome message
-                        welcome_channel = discord.utils.get(guild.text_channels, name="welcome")
-                        if welcome_channel:
-                            role = discord.utils.get(guild.roles, name=team_name.title())
-                            if role:
-                                await welcome_channel.send(
-                                    f"Welcome {member.mention} to team {team_name}! "
-                                    f"You've been assigned the {role.mention} role and "
-                                    f"can now access your team channels."
-                                )
-                    else:
-                        print(f"❌ Failed to assign role for {member.name} in {guild.name}")
-                    return
-        
-        # If we get here, we need to check for increased usage counts.
-        for invite in current_invites:
-            if invite.inviter == bot.user and invite.url in bot.invite_links:
-                invite_data = bot.invite_links[invite.url]
-                if invite_data['guild_id'] != guild.id:
-                    continue
-                    
-                tracked_uses = bot.invite_tracker.get(invite.url, 0)
-                print(f"🔍 Checking invite {invite.url}: tracked={tracked_uses} vs current={invite.uses}")
-                
-                if invite.uses > tracked_uses:
-                    used_invite = invite
-                    bot.invite_tracker[invite.url] = invite.uses
-                    print(f"🔑 Valid invite used: {invite.url}")
-                    break
+    worker = bot.join_workers.get(guild_id)
+    if worker is None or worker.done():
+        bot.join_workers[guild_id] = asyncio.create_task(join_worker(guild_id))
 
-        if used_invite:
-            invite_data = bot.invite_links[used_invite.url]
-            team_name = invite_data['team']
-            print(f"🎉 {member.name} joined using invite for {team_name}")
-            
-            # Assign role with retry logic
-            success = await assign_team_role(member, team_name)
-            if success:
-                # Create channels if they don't exist
-                await create_team_channels(guild, team_name)
-                
-                # Send welcome message
-                welcome_channel = discord.utils.get(guild.text_channels, name="welcome")
-                if welcome_channel:
-                    role = discord.utils.get(guild.roles, name=team_name.title())
-                    if role:
-                        await welcome_channel.send(
-                            f"Welcome {member.mention} to team {team_name}! "
-                            f"You've been assigned the {role.mention} role and "
-                            f"can now access your team channels."
-                        )
-            else:
-                print(f"❌ Failed to assign role for {member.name} in {guild.name}")
+async def join_worker(guild_id):
+    """Drain a guild's join queue, one invite snapshot for whatever is queued"""
+    log_context.set({'guild': guild_id})
+    join_queue = bot.join_queues[guild_id]
+    while True:
+        members = [await join_queue.get()]
+        while not join_queue.empty():
+            members.append(join_queue.get_nowait())
 
-    except Exception as e:
-        print(f"❌ Error in on_member_join: {str(e)}")
+        try:
+            with bot.metrics.timer('join_batch_seconds'):
+                pending = await attribute_joins(members[0].guild, members)
+            if pending:
+                retry_joins(members[0].guild, pending)
+        except Exception as e:
+            log.error(f"❌ Error in on_member_join: {str(e)}")
 
-async def create_team_channels(guild, team_name):
-    """Create team-specific channels with proper permissions"""
-    try:
-        # Generate consistent base name for both channels
-        base_name = "".join(c for c in team_name if c.isalnum() or c in " -_").strip().lower()
-        text_channel_name = f"{base_name}-chat"
-        voice_channel_name = f"{base_name}-voice"
-        
-        # Check ALL channels in the server (not just current category)
-        existing_text = discord.utils.find(
-            lambda c: c.name.lower() == text_channel_name.lower(),
-            guild.text_channels
+def retry_joins(guild, members):
+    """Queue members again for a later snapshot"""
+    for member in members:
+        asyncio.get_running_loop().call_later(JOIN_RETRY_DELAY, bot.join_queues[guild.id].put_nowait, member)
+
+async def attribute_joins(guild, members):
+    """Match a batch of joined members to the invites consumed since the last snapshot.
+
+    Returns the members whose invite use hasn't shown up yet, to try again with a later snapshot.
+    """
+    if not guild.me.guild_permissions.manage_guild:
+        log.error(f"❌ Missing MANAGE_GUILD permission in {guild.name}")
+        for member in members:
+            record_join(member, 'unmatched')
+        return []
+
+    # Get current invites and diff them against the last snapshot
+    async with snapshot_lock(guild.id):
+        consumed = consume_invite_snapshot(guild.id, await guild.invites())
+    now = time.monotonic()
+    pool = take_unclaimed_invites(guild.id, now)
+    for _, data in consumed:
+        mark_member_joined(data)
+    pool += [(now, url, data) for url, data in consumed]
+    log.debug("🔍 %d join(s) and %d used invite(s) in %s", len(members), len(pool), guild.name)
+
+    state = guild_state(guild.id)
+    expired = [member for member in members if now - state.join_started.setdefault(member.id, now) >= JOIN_MATCH_TIMEOUT]
+    if not pool:
+        # Discord hasn't counted the use yet, or they came in through another invite
+        if expired:
+            await report_unmatched_joins(guild, expired)
+        return [member for member in members if member not in expired]
+
+    teams = {data['team'] for _, _, data in pool}
+    if len(teams) > 1:
+        # Discord doesn't say which invite each member used, so mixed teams can't be told apart
+        await report_ambiguous_joins(guild, members, pool)
+        return []
+
+    if len(pool) < len(members):
+        if expired:
+            # Some of them came in through another invite and there's no telling who
+            await report_ambiguous_joins(guild, members, pool)
+            return []
+        # No telling which members the missing uses belong to, wait until they show up
+        state.unclaimed_invites.extend(pool)
+        return members
+    team_name = teams.pop()
+    if len(pool) > len(members):
+        # The remaining members' join events haven't arrived yet
+        state.unclaimed_invites.extend(pool[len(members):])
+
+    for member, (_, invite_url, data) in zip(members, pool):
+        mark_member_joined(data, member.id)
+        log.info(f"🎉 {member.name} joined using invite {invite_url} for {team_name}")
+        # Welcoming runs in the background so the worker is free for the next snapshot before other teams pile in
+        welcome = asyncio.create_task(welcome_team_member(member, team_name))
+        bot.welcome_tasks.add(welcome)
+        welcome.add_done_callback(welcome_finished)
+
+def welcome_finished(task):
+    bot.welcome_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        log.error(f"❌ Error welcoming a member: {str(task.exception())}", exc_info=task.exception())
+
+async def report_ambiguous_joins(guild, members, pool):
+    """Ask admins to assign roles by hand when a batch spans several teams"""
+    names = ", ".join(member.mention for member in members)
+    candidates = "\n".join(f"• {data['team']} ({data.get('member_email') or 'unknown email'})" for _, _, data in pool[:20])
+    if len(pool) > 20:
+        candidates += f"\n(+{len(pool) - 20} more)"
+    log.warning(f"⚠️ Ambiguous joins in {guild.name}: {len(members)} member(s) across {len(pool)} invites")
+    for member in members:
+        record_join(member, 'ambiguous')
+
+    channel = guild_index(guild).get('text', "teammanagerbot")
+    if channel:
+        await channel.send(
+            f"⚠️ Couldn't tell which invite each of {names} used. "
+            f"Please assign their team roles manually. Invites used:\n{candidates}"
         )
-        existing_voice = discord.utils.find(
-            lambda c: c.name.lower() == voice_channel_name.lower(), 
-            guild.voice_channels
+
+async def report_unmatched_joins(guild, members):
+    """Ask admins to assign roles by hand for members no bot invite was used for"""
+    for member in members:
+        log.warning(f"⚠️ Couldn't match an invite for {member.name} in {guild.name}")
+        record_join(member, 'unmatched')
+
+    channel = guild_index(guild).get('text', "teammanagerbot")
+    if channel:
+        await channel.send(
+            f"⚠️ No team invite was used by {', '.join(member.mention for member in members)} "
+            f"within {JOIN_MATCH_TIMEOUT:g}s of joining. If they are participants, please assign their team roles manually."
         )
 
-        # If channels exist anywhere, skip creation
-        if existing_text or existing_voice:
-            print(f"⚠️ Channels already exist for team {team_name}")
-            return True
+def record_join(member, outcome):
+    """Count a join's outcome and, once its role is in place, its join-to-role latency"""
+    started = guild_state(member.guild.id).join_started.pop(member.id, None)
+    bot.metrics.inc('joins_total', outcome)
+    if outcome == 'assigned' and started is not None:
+        bot.metrics.observe('join_to_role_seconds', '', time.monotonic() - started)
 
-        # Create team role first (if it doesn't exist)
-        role_name = team_name.title()
-        role = discord.utils.get(guild.roles, name=role_name)
-        if not role:
-            role = await guild.create_role(
-                name=role_name,
-                color=discord.Color.random(),
-                hoist=True,
-                mentionable=True,
-                reason=f"Auto-created for {team_name}"
-            )
-            print(f"✅ Created role: {role_name} in {guild.name}")
-            
-            # Position role below bot's role
-            try:
-                if guild.me.top_role.position > 1:
-                    await role.edit(position=guild.me.top_role.position - 1)
-            except:
-                print("⚠️ Couldn't reposition role - ensure bot role is high enough")
-
-        # Configure permissions
-        ADMIN_ROLES = ["Admin", "Moderator", "Organiser", "Formateur", "Supervisor", "Responsable", "President"]
-        overwrites = {
-            guild.default_role: discord.PermissionOverwrite( # Default-role permissions
-                read_messages=False,
-                view_channel=False,
-                connect=False
-            ),
-            role: discord.PermissionOverwrite( # The assigned team roles permissions
-                read_messages=True,
-                view_channel=True,
-                send_messages=True,
-                connect=True,
-                speak=True
-            )
-        }
+async def welcome_team_member(member, team_name):
+    """Give a new member their team role, channels and a welcome message"""
+    guild = member.guild
 
-        # Add admin permissions
-        for admin_role_name in ADMIN_ROLES:
-            admin_role = discord.utils.get(guild.roles, name=admin_role_name)
-            if admin_role:
-                # Admins as well as other roles present in ADMIN_ROLES can access the team channels
-                overwrites[admin_role] = discord.PermissionOverwrite(
-                    read_messages=True,
-                    view_channel=True,
-                    send_messages=True,
-                    manage_messages=True,
-                    connect=True,
-                    speak=True,
-                    manage_channels=True
-                )
+    # Assign role with retry logic
+    success = await assign_team_role(member, team_name)
+    record_join(member, 'assigned' if success else 'failed')
+    if not success:
+        log.error(f"❌ Failed to assign role for {member.name} in {guild.name}")
+        return False
 
-        # Find or create category, we re grouping each four teams in a bigger team Discord category
-        teams_category = next((
-            cat for cat in guild.categories 
-            if cat.name.startswith("TEAM ") 
-            and len(cat.channels) < 8  # (4 text + 4 voice)
-        ), None)
-        
-        if not teams_category:
-            # Count existing team channels to determine new category number
-            team_channels = [
-                c for c in guild.channels 
-                if any(c.name.lower().endswith(suffix) for suffix in ["-chat", "-voice"])
-            ]
-            category_number = (len(team_channels) // 8) + 1  # 4 teams per category, two channels for each.
-            category_name = f"TEAM {category_number}"
-            teams_category = await guild.create_category(category_name)
-            print(f"✅ Created category {category_name} in {guild.name}")
-
-        # Create text channel if it doesn't exist
-        if not existing_text:
-            await guild.create_text_channel(
-                text_channel_name,
-                overwrites=overwrites,
-                category=teams_category,
-                reason=f"Team {team_name} text channel"
-            )
-            print(f"✅ Created text channel: {text_channel_name}")
+    # Create channels if they don't exist
+    await create_team_channels(guild, team_name)
 
-        # Create voice channel if it doesn't exist
-        if not existing_voice:
-            await guild.create_voice_channel(
-                voice_channel_name,
-                overwrites=overwrites,
-                category=teams_category,
-                reason=f"Team {team_name} voice channel"
+    # Send welcome message
+    index = guild_index(guild)
+    welcome_channel = index.get('text', "welcome")
+    if welcome_channel:
+        role = index.get('role', team_role_name(team_name))
+        if role:
+            await welcome_channel.send(
+                f"Welcome {member.mention} to team {team_name}! "
+                f"You've been assigned the {role.mention} role and "
+                f"can now access your team channels."
             )
-            print(f"✅ Created voice channel: {voice_channel_name}")
+    return True
 
-        return True
+async def create_team_channels(guild, team_name):
+    """Create team-specific channels with proper permissions"""
+    try:
+        async with provisioning_lock(guild):
+            plan = plan_team_provisioning(guild, [team_name])
+            if not plan['channels'] and not plan['roles']:
+                return True
+            failed = await execute_provisioning_plan(guild, plan)
+        return team_name not in failed
 
     except discord.Forbidden as e:
-        print(f"❌ Permission error in {guild.name}: {str(e)}")
+        log.error(f"❌ Permission error in {guild.name}: {str(e)}")
         return False
     except Exception as e:
-        print(f"❌ Error in {guild.name}: {str(e)}")
+        log.error(f"❌ Error in {guild.name}: {str(e)}")
+        return False
+
+async def remove_team_role(guild, member_id, team_name):
+    """Take a team role away from a member who left the roster or changed team"""
+    member = guild.get_member(member_id) if member_id else None
+    role = guild_index(guild).get('role', team_role_name(team_name))
+    if not member or not role or role not in member.roles:
+        return False
+    try:
+        await member.remove_roles(role, reason="Roster update")
+        return True
+    except discord.HTTPException as e:
+        log.warning(f"⚠️ Couldn't remove {role.name} from {member.name}: {str(e)}")
         return False
 
 async def assign_team_role(member, team_name):
     try:
         guild = member.guild
-        role_name = "".join(c for c in team_name if c.isalnum() or c in " -_").strip().title()
+        role_name = team_role_name(team_name)
         
         if not guild.me.guild_permissions.manage_roles:
-            print(f"❌ Missing MANAGE_ROLES in {guild.name}")
+            log.error(f"❌ Missing MANAGE_ROLES in {guild.name}")
             return False
 
-        role = discord.utils.get(guild.roles, name=role_name)
+        role = guild_index(guild).get('role', role_name)
         if not role:
-            role = await guild.create_role(
-                name=role_name,
-                color=discord.Color.random(),
-                hoist=True,
-                mentionable=True,
-                reason=f"auto-created for {team_name}"
-            )
-            print(f"✅ Created role: {role_name} in {guild.name}")
-            
-            # Move the role position AFTER creation
-            try:
-                await role.edit(position=guild.me.top_role.position - 1)
-                print(f"🔀 Moved {role_name} to position {role.position}")
-            except Exception as e:
-                print(f"⚠️ Couldn't position role: {str(e)}")
+            # Provision the whole team at once so the role is created and positioned like any other
+            await create_team_channels(guild, team_name)
+            role = guild_index(guild).get('role', role_name)
+            if not role:
+                return False
 
         if role not in member.roles:
-            print(f"⚙️ {guild.name} Hierarchy Check | Bot: {guild.me.top_role.position} vs {role_name}: {role.position}")
+            log.debug(
+                "⚙️ %s Hierarchy Check | Bot: %s vs %s: %s",
+                guild.name, guild.me.top_role.position, role_name, role.position,
+            )
             if guild.me.top_role.position > role.position:
                 await member.add_roles(role)
                 return True
             else:
-                print(f"❌ Fix required: Drag @{guild.me.top_role.name} above @{role.name} in {guild.name}")
+                log.error(f"❌ Fix required: Drag @{guild.me.top_role.name} above @{role.name} in {guild.name}")
                 return False
         return True
 
     except discord.Forbidden:
-        print(f"❌ Missing permissions in {guild.name}")
+        log.error(f"❌ Missing permissions in {guild.name}")
         return False
     except Exception as e:
-        print(f"❌ Error in {guild.name}: {str(e)}")
+        log.error(f"❌ Error in {guild.name}: {str(e)}")
         return False
 
+# ----------------------------
+# INVITE RECONCILIATION
+# ----------------------------
+INVITE_RECONCILE_INTERVAL = float(os.getenv('INVITE_RECONCILE_INTERVAL', 300))  # Seconds between invite snapshots, 0 disables
+INVITE_REMINT = os.getenv('INVITE_REMINT', 'false').lower() == 'true'  # Replace dead invites of members who haven't joined
+
+bot.snapshot_locks = {}  # {guild_id: asyncio.Lock} so snapshots apply in order and never race a newly minted invite
+
+def snapshot_lock(guild_id):
+    if guild_id not in bot.snapshot_locks:
+        bot.snapshot_locks[guild_id] = asyncio.Lock()
+    return bot.snapshot_locks[guild_id]
+
+def take_unclaimed_invites(guild_id, now):
+    """Empty the guild's pool of used invites still waiting for a join, retiring the ones that waited too long"""
+    state = guild_state(guild_id)
+    pool = []
+    for seen_at, invite_url, data in state.unclaimed_invites:
+        if now - seen_at < UNCLAIMED_INVITE_TTL:
+            pool.append((seen_at, invite_url, data))
+        else:
+            retire_invite(invite_url, data)
+    state.unclaimed_invites = []
+    return pool
+
+def retire_invite(invite_url, data):
+    """A member invite vanished and no join ever claimed it: it was revoked or expired, not used"""
+    state = guild_state(data['guild_id'])
+    if not data.get('member_email') or invite_url in state.invite_links:
+        return
+    key = invite_key(data['guild_id'], data['team'], data['member_email'])
+    if key in state.joined_members or key in state.invite_index:
+        return
+    state.dead_invites[key] = invite_url
+    bot.metrics.inc('invites_dead_total')
+    log.warning(f"💀 Invite {invite_url} for {data['member_email']} ({data['team']}) was revoked or expired")
+
+async def reconcile_guild_invites(guild):
+    """Apply one invite snapshot: park used invites for their joins, retire dead ones, optionally replace them"""
+    state = guild_state(guild.id)
+    async with snapshot_lock(guild.id):
+        consumed = consume_invite_snapshot(guild.id, await guild.invites())
+    now = time.monotonic()
+    # Joins that are still queued pick these up from the pool, join-time snapshots only see what's newer
+    state.unclaimed_invites = take_unclaimed_invites(guild.id, now) + [(now, url, data) for url, data in consumed]
+    if consumed:
+        log.info(f"🔄 {len(consumed)} invite(s) used or removed since the last snapshot in {guild.name}")
+
+    if not INVITE_REMINT or not state.dead_invites or ATTRIBUTION_MODE == 'claim':
+        return
+    recipients = []
+    for guild_id, team_name, member_email in list(state.dead_invites):
+        member = state.roster.find_email(member_email)
+        if member and member.team == team_name:
+            recipients.append((team_name, member))
+        else:
+            del state.dead_invites[(guild_id, team_name, member_email)]  # No longer on the roster
+    channel = guild_index(guild).get('text', "teammanagerbot")
+    if not recipients or not channel:
+        return
+    _, minted = await mint_member_invites(guild, channel, recipients)
+    log.info(f"🔗 Re-minted {minted}/{len(recipients)} dead invite(s) in {guild.name}")
+    if minted and os.getenv('EMAIL_ADDRESS') and os.getenv('EMAIL_PASSWORD'):
+        queued, _ = queue_outbox(guild.id, recipients)
+        sent = 0
+        async for _, _, ok in email_member_invites(queued):
+            sent += ok
+        log.info(f"📧 Emailed {sent}/{len(queued)} replacement invite(s) in {guild.name}")
+
+@tasks.loop(seconds=INVITE_RECONCILE_INTERVAL or 300)
+async def reconcile_invites():
+    """Keep every guild's invite tracker current between joins"""
+    limiter = asyncio.Semaphore(GUILD_INIT_CONCURRENCY)
+
+    async def reconcile(guild):
+        log_context.set({'guild': guild.id})
+        state = bot.guild_states.get(guild.id)
+        if not state or not state.invite_tracker or not guild.me.guild_permissions.manage_guild:
+            return
+        async with limiter:
+            try:
+                with bot.metrics.timer('invite_reconcile_seconds'):
+                    await reconcile_guild_invites(guild)
+            except discord.HTTPException as e:
+                log.warning(f"⚠️ Invite reconciliation failed in {guild.name}: {str(e)}")
+
+    await asyncio.gather(*(reconcile(guild) for guild in bot.guilds))
+
+@reconcile_invites.before_loop
+async def wait_for_ready():
+    await bot.wait_until_ready()
+
+# ----------------------------
+# CLAIM CODE ATTRIBUTION
+# ----------------------------
+ATTRIBUTION_MODE = os.getenv('ATTRIBUTION_MODE', 'invites').lower()  # 'invites': one invite per member, 'claim': shared invite + claim codes
+CLAIM_CHANNEL = "claim-your-team"  # Landing channel the shared invite points to
+CLAIM_CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # No 0/O or 1/I look-alikes
+CLAIM_CODE_LENGTH = 8
+
+def normalize_claim_code(code):
+    return "".join(str(code).split()).replace("-", "").upper()
+
+def format_claim_code(code):
+    """Display form, e.g. ABCD-EFGH"""
+    return f"{code[:4]}-{code[4:]}"
+
+def issue_claim_codes(guild_id, recipients):
+    """Give every (team_name, member) a claim code, keeping existing ones; returns how many are new"""
+    state = guild_state(guild_id)
+    new_codes = []
+    for team_name, member in recipients:
+        key = invite_key(guild_id, team_name, member.email)
+        if key in state.member_claims:
+            continue
+        code = "".join(secrets.choice(CLAIM_CODE_ALPHABET) for _ in range(CLAIM_CODE_LENGTH))
+        while code in state.claim_codes:
+            code = "".join(secrets.choice(CLAIM_CODE_ALPHABET) for _ in range(CLAIM_CODE_LENGTH))
+        state.claim_codes[code] = key
+        state.member_claims[key] = code
+        new_codes.append((code, key))
+    bot.store.save_claim_codes(new_codes)
+    return len(new_codes)
+
+def revoke_claim_code(key):
+    """Forget a member's claim code so it can no longer be redeemed"""
+    state = guild_state(key[0])
+    code = state.member_claims.pop(key, None)
+    if code:
+        del state.claim_codes[code]
+        bot.store.delete_claim_code(code)
+    return code is not None
+
+def member_invite_url(key):
+    """The link a member is emailed: their own invite, or the shared landing invite in claim mode"""
+    state = guild_state(key[0])
+    if ATTRIBUTION_MODE == 'claim' and key in state.member_claims:
+        return state.claim_landing
+    return state.invite_index.get(key)
+
+async def ensure_claim_landing(guild):
+    """Create the landing channel and its claim button if needed, returns the shared invite URL"""
+    index = guild_index(guild)
+    channel = index.get('text', CLAIM_CHANNEL)
+    if not channel:
+        channel = await guild.create_text_channel(
+            CLAIM_CHANNEL,
+            overwrites={guild.default_role: discord.PermissionOverwrite(send_messages=False)},
+            reason="Team claim landing channel"
+        )
+        index.add('text', channel)
+        await channel.send(
+            "👋 Welcome! Press the button below and enter the claim code from your invite email to join your team.",
+            view=ClaimView()
+        )
+    # Without unique=True Discord hands back the same permanent invite on every call
+    invite = await channel.create_invite(max_age=0, max_uses=0, unique=False, reason="Team claim landing invite")
+    state = guild_state(guild.id)
+    if state.claim_landing != invite.url:
+        state.claim_landing = invite.url
+        bot.store.save_claim_landing(guild.id, invite.url)
+    return invite.url
+
+async def claim_team(member, raw_code):
+    """Resolve a claim code with one dict lookup and give the member their team"""
+    state = guild_state(member.guild.id)
+    key = state.claim_codes.get(normalize_claim_code(raw_code))
+    if not key:
+        bot.metrics.inc('claims_total', 'unknown')
+        return "❌ Unknown claim code, please check your invite email."
+
+    guild_id, team_name, member_email = key
+    owner = state.joined_members.get(key)
+    if owner and owner != member.id:
+        bot.metrics.inc('claims_total', 'taken')
+        log.warning(f"⚠️ {member.name} tried to claim {member_email}'s code, already used by {owner}")
+        return "❌ This code was already used by another account. Please ask an organiser for help."
+
+    mark_member_joined({'guild_id': guild_id, 'team': team_name, 'member_email': member_email}, member.id)
+    bot.metrics.inc('claims_total', 'accepted')
+    log.info(f"🎟️ {member.name} claimed {team_name} as {member_email}")
+    if not await welcome_team_member(member, team_name):
+        return "⚠️ Your code is valid but your team role couldn't be assigned. Please ask an organiser for help."
+    return f"✅ Welcome to team {team_name}! Your team channels are now visible."
+
+class ClaimModal(discord.ui.Modal, title="Claim your team"):
+    code = discord.ui.TextInput(
+        label="Claim code from your invite email",
+        placeholder="ABCD-EFGH",
+        min_length=CLAIM_CODE_LENGTH,
+        max_length=CLAIM_CODE_LENGTH + 4
+    )
+
+    async def on_submit(self, interaction):
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        await interaction.followup.send(await claim_team(interaction.user, self.code.value), ephemeral=True)
+
+class ClaimView(discord.ui.View):
+    """Persistent claim button under the landing channel's welcome message"""
+
+    def __init__(self):
+        super().__init__(timeout=None)
+
+    @discord.ui.button(label="🎟️ Claim my team", style=discord.ButtonStyle.primary, custom_id="team_claim")
+    async def claim_button(self, interaction, button):
+        await interaction.response.send_modal(ClaimModal())
+
+@bot.hybrid_command(name="claim", description="Join your team with the claim code from your invite email")
+@commands.guild_only()
+async def claim(ctx, code: str):
+    await ctx.defer(ephemeral=True)
+    await ctx.send(await claim_team(ctx.author, code), ephemeral=True)
+
+async def create_claims_job(ctx, file_format):
+    """/create_invites in claim mode: one shared invite plus a claim code per member"""
+    state = guild_state(ctx.guild.id)
+    if not state.roster:
+        return await ctx.send("❌ No team data loaded! Use `/load` first.")
+
+    try:
+        landing_url = await ensure_claim_landing(ctx.guild)
+        recipients = [
+            (team_name, member) for team_name, members in state.roster.items() for member in members
+            if invite_key(ctx.guild.id, team_name, member.email) not in state.joined_members
+        ]
+        issued = issue_claim_codes(ctx.guild.id, recipients)
+
+        rows = []
+        for team_name, members in state.roster.items():
+            for member in members:
+                key = invite_key(ctx.guild.id, team_name, member.email)
+                code = state.member_claims.get(key)
+                status = "joined" if key in state.joined_members else "issued"
+                rows.append((team_name, member.email, format_claim_code(code) if code else '', status))
+
+        embed = discord.Embed(
+            title="🎟️ Claim Codes",
+            color=discord.Color.green(),
+            description=f"Everyone joins through {landing_url} and claims their team in #{CLAIM_CHANNEL}"
+        )
+        embed.add_field(name="New codes", value=str(issued))
+        embed.add_field(name="Existing codes", value=str(len(recipients) - issued))
+        embed.add_field(name="Already joined", value=str(len(rows) - len(recipients)))
+        await send_report(
+            ctx, embed,
+            export_table("claim_codes", ["team", "email", "claim_code", "status"], rows, file_format),
+            [f"{team} · {email} · {code or status}" for team, email, code, status in rows]
+        )
+    except discord.Forbidden as e:
+        await ctx.send(f"❌ Missing permissions to set up the claim channel: {str(e)}")
+    except Exception as e:
+        await ctx.send(f"❌ Error creating claim codes: {str(e)}")
+        log.error(f"❌ Global error in create_claims_job: {str(e)}")
+
+# ----------------------------
+# EVENT TEARDOWN
+# ----------------------------
+TEARDOWN_ORDER = ('invites', 'channels', 'categories', 'roles')  # Stop new joins first, roles go last
+TEARDOWN_REASONS = ("Team ", "Auto-created for ", "auto-created for ")  # Audit reasons on what the bot creates
+
+async def plan_teardown(guild):
+    """Find what the bot created for the event and still exists, by name pattern and audit reason.
+
+    Returns {kind: {id: object}} for the kinds in TEARDOWN_ORDER, plus 'kept' for
+    channels someone else put in a team category and the categories holding them.
+    Planning from what is left means an interrupted teardown resumes when run again.
+    """
+    index = guild_index(guild)
+    state = guild_state(guild.id)
+    me = guild.me
+    plan = {kind: {} for kind in TEARDOWN_ORDER}
+
+    for category in index.all('category'):
+        if team_category_number(category.name) is not None:
+            plan['categories'][category.id] = category
+
+    team_names = set(state.roster) | {data['team'] for data in state.invite_links.values()}
+    for team_name in team_names:
+        for kind, channel_name in zip(('text', 'voice'), team_channel_names(team_name)):
+            channel = index.get(kind, channel_name)
+            if channel:
+                plan['channels'][channel.id] = channel
+        role = index.get('role', team_role_name(team_name))
+        if role:
+            plan['roles'][role.id] = role
+    claim_channel = index.get('text', CLAIM_CHANNEL)
+    if claim_channel:
+        plan['channels'][claim_channel.id] = claim_channel
+
+    # Teams from earlier rosters are only known to the audit log
+    if me.guild_permissions.view_audit_log:
+        for action, lookup in (
+            (discord.AuditLogAction.channel_create, guild.get_channel),
+            (discord.AuditLogAction.role_create, guild.get_role)
+        ):
+            async for entry in guild.audit_logs(limit=None, user=me, action=action):
+                target = lookup(entry.target.id) if entry.target else None
+                if not target or not (entry.reason or '').startswith(TEARDOWN_REASONS):
+                    continue
+                if action is discord.AuditLogAction.role_create:
+                    plan['roles'][target.id] = target
+                elif target.type == discord.ChannelType.category:
+                    plan['categories'][target.id] = target
+                else:
+                    plan['channels'][target.id] = target
+
+    if me.guild_permissions.manage_guild:
+        for invite in await guild.invites():
+            if invite.inviter == bot.user:
+                plan['invites'][invite.code] = invite
+
+    # Channels the bot didn't create stay where they are, and so does their category
+    plan['kept'] = {}
+    for category_id, category in list(plan['categories'].items()):
+        others = [channel for channel in category.channels if channel.id not in plan['channels']]
+        if others:
+            plan['kept'].update((channel.id, channel) for channel in others)
+            plan['kept'][category_id] = plan['categories'].pop(category_id)
+
+    # Never touch roles the bot can't or shouldn't manage
+    for role_id, role in list(plan['roles'].items()):
+        if role.managed or role == guild.default_role or role.position >= me.top_role.position or role.name in ADMIN_ROLES:
+            del plan['roles'][role_id]
+    return plan
+
+def describe_teardown(plan):
+    return ", ".join(f"{len(plan[kind])} {kind}" for kind in TEARDOWN_ORDER)
+
+def forget_event(guild_id):
+    """Drop a guild's roster, invites, joins, claim codes and email history"""
+    bot.guild_states.pop(guild_id, None)
+    bot.category_slots.pop(guild_id, None)
+    bot.store.clear_guild(guild_id)
+
+@bot.hybrid_command(name="teardown", description="Delete the channels, roles and invites created for the event")
+@commands.has_any_role("Admin", "Moderator", "Leaders", "admin", "leader", "president")
+async def teardown(ctx, confirm: bool = False, file_format: EXPORT_FORMATS = 'csv'):
+    """Dry run by default, confirm:True deletes everything in a background job"""
+    if confirm:
+        return await submit_job(ctx, "teardown", teardown_job)
+
+    await ctx.defer()
+    plan = await plan_teardown(ctx.guild)
+    rows = [
+        (kind, getattr(obj, 'name', None) or obj.url, obj.id)
+        for kind in TEARDOWN_ORDER + ('kept',) for obj in plan[kind].values()
+    ]
+    embed = discord.Embed(
+        title="🧹 Teardown Dry Run",
+        color=discord.Color.orange(),
+        description=(
+            f"Would delete {describe_teardown(plan)}, then forget the saved roster, invites and email history.\n"
+            "Run `/teardown confirm:True` to go ahead."
+        )
+    )
+    if plan['kept']:
+        embed.add_field(
+            name="📌 Left in place",
+            value=f"{len(plan['kept'])} channel(s) and categories the bot didn't create, listed as `kept`"
+        )
+    if not ctx.guild.me.guild_permissions.view_audit_log:
+        embed.add_field(name="⚠️ No audit log access", value="Only teams in the current roster were found, other channels in TEAM categories are kept")
+    await send_report(
+        ctx, embed,
+        export_table("teardown", ["kind", "name", "id"], rows, file_format),
+        [f"{kind} · {name}" for kind, name, _ in rows]
+    )
+
+async def teardown_job(ctx):
+    guild = ctx.guild
+    await ctx.progress.update("🔎 Finding what the event created...", force=True)
+    plan = await plan_teardown(guild)
+    total = sum(len(plan[kind]) for kind in TEARDOWN_ORDER)
+    done = 0
+    failures = []
+    limiter = asyncio.Semaphore(PROVISION_CONCURRENCY)  # discord.py waits out each route's rate limit on its own
+    index = guild_index(guild)
+
+    async def delete(kind, obj):
+        nonlocal done
+        async with limiter:
+            try:
+                await obj.delete(reason="Event teardown")
+            except discord.NotFound:
+                pass  # Already gone
+            except discord.HTTPException as e:
+                failures.append((kind, getattr(obj, 'name', None) or obj.url, str(e)))
+                log.error(f"❌ Couldn't delete {kind[:-1]} {getattr(obj, 'name', None) or obj.url} in {guild.name}: {str(e)}")
+            else:
+                if kind == 'roles':
+                    index.remove('role', obj)
+                elif kind != 'invites':
+                    index.remove(CHANNEL_KINDS.get(obj.type), obj)
+            done += 1
+            await ctx.progress.update(f"🧹 Tearing down... {done}/{total}")
+
+    started = time.perf_counter()
+    for kind in TEARDOWN_ORDER:
+        # Categories must be empty before they go, so kinds run in order and each kind in parallel
+        await asyncio.gather(*(delete(kind, obj) for obj in plan[kind].values()))
+
+    if failures:
+        await ctx.progress.update(f"⚠️ Teardown stopped with {len(failures)} failure(s), run `/teardown confirm:True` again to retry", force=True)
+        await ctx.send("\n".join(f"• {kind[:-1]} {name}: {error}" for kind, name, error in failures[:15]))
+        return
+    forget_event(guild.id)
+    await ctx.progress.update(f"✅ Deleted {describe_teardown(plan)} in {time.perf_counter() - started:.1f}s", force=True)
+    log.info(f"🧹 Tore down the event in {guild.name}: {describe_teardown(plan)}")
+
 # ----------------------------
 # UTILITY COMMANDS
 # ----------------------------
 @bot.hybrid_command(name="team_info", description="Show loaded team data")
 @commands.has_any_role("Admin", "Moderator", "Leaders", "admin", "leader", "president")
-async def team_info(ctx):
-    if not bot.team_data:
+async def team_info(ctx, file_format: EXPORT_FORMATS = 'csv'):
+    state = guild_state(ctx.guild.id)
+    if not state.roster:
         return await ctx.send("No team data loaded! Use `/load` first.")
     
+    rows = []
+    pages = []
+    for team, users in state.roster.items():
+        for u in users:
+            key = invite_key(ctx.guild.id, team, u.email)
+            rows.append((
+                team, u.firstname, u.lastname, u.email,
+                state.invite_index.get(key, ''), "yes" if key in state.joined_members else "no"
+            ))
+        names = ", ".join(f"{u.firstname} {u.lastname}" for u in users)
+        pages.append(f"**Team {team}** ({len(users)}): {names[:200]}")
+
     embed = discord.Embed(
         title="📊 Team Information",
         color=discord.Color.blue(),
-        description=f"Total {sum(len(u) for u in bot.team_data.values())} users"
+        description=f"Total {len(rows)} users across {len(state.roster.teams)} teams"
     )
-    
-    for team, users in bot.team_data.items():
-        members = "\n".join(
-            f"{u['firstname']} {u['lastname']} ({u['email']})"
-            for u in users[:3]
-        )
-        if len(users) > 3:
-            members += f"\n...and {len(users)-3} more"
-        embed.add_field(name=f"Team {team}", value=members, inline=False)
-    
-    # Check if embed is too large (Discord limit is around 6000 characters for embeds)
-    if len(embed) > 6000:
-        # Fall back to text-based output with chunking
-        message = "**📊 Team Information**\n"
-        message += f"Total {sum(len(u) for u in bot.team_data.values())} users\n\n"
-        
-        for team, users in bot.team_data.items():
-            message += f"**Team {team}**\n"
-            for i, user in enumerate(users[:3]):
-                message += f"{user['firstname']} {user['lastname']} ({user['email']})\n"
-            if len(users) > 3:
-                message += f"...and {len(users)-3} more\n"
-            message += "\n"
-        
-        # Split message if too long
-        if len(message) > 2000:
-            chunks = [message[i:i+2000] for i in range(0, len(message), 2000)]
-            for chunk in chunks:
-                await ctx.send(chunk)
+    embed.add_field(name="Invited", value=str(sum(1 for row in rows if row[4])))
+    embed.add_field(name="Joined", value=str(sum(1 for row in rows if row[5] == "yes")))
+    await send_report(
+        ctx, embed,
+        export_table("teams", ["team", "firstname", "lastname", "email", "invite_url", "joined"], rows, file_format),
+        pages
+    )
+
+@bot.hybrid_command(name="find", description="Look up a participant by email or name prefix")
+@commands.has_any_role("Admin", "Moderator", "Leaders", "admin", "leader", "president")
+async def find(ctx, query: str):
+    state = guild_state(ctx.guild.id)
+    if not state.roster:
+        return await ctx.send("No team data loaded! Use `/load` first.")
+
+    exact = state.roster.find_email(query) if '@' in query else None
+    matches = [exact] if exact else state.roster.search(query, limit=FIND_LIMIT + 1)
+    if not matches:
+        return await ctx.send(f"🔍 No participant matches `{query}`.")
+
+    count = str(len(matches)) if len(matches) <= FIND_LIMIT else f"{FIND_LIMIT}+"
+    embed = discord.Embed(title=f"🔍 {count} match(es) for `{query}`", color=discord.Color.blue())
+    for member in matches[:FIND_LIMIT]:
+        key = invite_key(ctx.guild.id, member.team, member.email)
+        if key in state.joined_members:
+            member_id = state.joined_members[key]
+            status = f"joined as <@{member_id}>" if member_id else "joined"
+        elif key in state.dead_invites:
+            status = "invite revoked or expired, run `/create_invites` to replace it"
+        elif key in state.member_claims:
+            status = f"claim code {format_claim_code(state.member_claims[key])}"
         else:
-            await ctx.send(message)
-    else:
-        await ctx.send(embed=embed)
+            status = state.invite_index.get(key) or "no invite yet"
+        outbox = state.outbox.get(key)
+        if outbox:
+            status += f" · email {outbox['status']}"
+        embed.add_field(name=f"{member.firstname} {member.lastname} · Team {member.team}", value=f"{member.email}\n{status}", inline=False)
+    await ctx.send(embed=embed)
 
 @bot.hybrid_command(name="invite_info", description="Show active invite links")
 @commands.has_any_role("Admin", "Moderator", "Leaders", "admin", "leader", "president")
-async def invite_info(ctx):
-    if not bot.invite_links:
+async def invite_info(ctx, file_format: EXPORT_FORMATS = 'csv'):
+    rows = [
+        (data['team'], data.get('member_email') or '', url, tracked_uses(ctx.guild.id, url))
+        for url, data in guild_state(ctx.guild.id).invite_links.items()
+    ]
+    if not rows:
         return await ctx.send("No invites created! Use `/create_invites` first.")
     
-    embed = discord.Embed(title="🔗 Active Invite Links", color=discord.Color.green())
-    
-    for url, team in bot.invite_links.items():
-        uses = bot.invite_tracker.get(url, 0)
+    embed = discord.Embed(
+        title="🔗 Active Invite Links",
+        color=discord.Color.green(),
+        description=f"{len(rows)} active invites, {sum(row[3] for row in rows)} total uses"
+    )
+    await send_report(
+        ctx, embed,
+        export_table("invite_links", ["team", "email", "invite_url", "uses"], rows, file_format),
+        [f"Team {team} · {email or 'unknown'} · uses {uses} · {url}" for team, email, url, uses in rows]
+    )
+
+@bot.hybrid_command(name="stats", description="Show command latency, API calls and rate limit waits")
+@commands.has_any_role("Admin", "Moderator", "Leaders", "admin", "leader", "president")
+async def stats(ctx, file_format: EXPORT_FORMATS = 'csv'):
+    metrics = bot.metrics
+    histograms = metrics.rows()
+    if not histograms and not metrics.counters:
+        return await ctx.send("No metrics recorded yet.")
+
+    def ms(seconds):
+        return f"{seconds * 1000:.0f}ms"
+
+    embed = discord.Embed(
+        title="📈 Bot Metrics",
+        color=discord.Color.blue(),
+        description=f"Uptime {time.monotonic() - metrics.started:.0f}s"
+    )
+    embed.add_field(name="Discord calls", value=str(metrics.total('discord_calls_total')))
+    embed.add_field(name="429s", value=str(metrics.total('discord_429_total')))
+    embed.add_field(name="Rate limit waits", value=f"{metrics.total('ratelimit_wait_seconds_total'):.1f}s")
+    embed.add_field(name="Emails/min", value=f"{metrics.rate('emails_sent') * 60:.1f}")
+    join_latency = metrics.histograms.get(('join_to_role_seconds', ''))
+    if join_latency and join_latency.count:
         embed.add_field(
-            name=f"Team {team}",
-            value=f"Uses: {uses}\n{url}",
-            inline=False
+            name="Join → role",
+            value=f"p50 {ms(join_latency.quantile(0.5))} · p95 {ms(join_latency.quantile(0.95))}"
         )
-    
-    # Check if embed is too large
-    if len(embed) > 6000:
-        # Fall back to text-based output with chunking
-        message = "**🔗 Active Invite Links**\n\n"
-        
-        for url, data in bot.invite_links.items():
-            uses = bot.invite_tracker.get(url, 0)
-            team_name = data['team'] if isinstance(data, dict) else data
-            message += f"**Team {team_name}**\n"
-            message += f"Uses: {uses}\n{url}\n\n"
-        
-        # Split message if too long
-        if len(message) > 2000:
-            chunks = [message[i:i+2000] for i in range(0, len(message), 2000)]
-            for chunk in chunks:
-                await ctx.send(chunk)
-        else:
-            await ctx.send(message)
-    else:
-        await ctx.send(embed=embed)
 
+    # Where time goes: biggest total time first
+    histograms.sort(key=lambda row: row[2] * row[3], reverse=True)
+    lines = [
+        f"`{name}` {label} · {count}× · avg {ms(avg)} · p95 {ms(p95)} · max {ms(peak)}"
+        for name, label, count, avg, _, p95, peak in histograms
+    ]
+    lines += [f"`{name}` {label} · {value:g}" for (name, label), value in sorted(metrics.counters.items())]
+
+    rows = [
+        (name, label, count, round(avg * 1000, 1), round(p50 * 1000, 1), round(p95 * 1000, 1), round(peak * 1000, 1))
+        for name, label, count, avg, p50, p95, peak in histograms
+    ]
+    rows += [(name, label, value, '', '', '', '') for (name, label), value in sorted(metrics.counters.items())]
+    await send_report(
+        ctx, embed,
+        export_table("metrics", ["metric", "label", "count", "avg_ms", "p50_ms", "p95_ms", "max_ms"], rows, file_format),
+        lines
+    )
 
 # ----------------------------
 # HELP COMMAND
@@ -713,11 +3192,18 @@ async def help_command(ctx):
     )
     
     commands_list = [
-        ("/load <file_path>", "Load user data from Excel file"),
+        ("/load <file_path|attachment>", "Load user data from a CSV/Excel file"),
         ("/create_invites", "Generate team-specific invite links"),
         ("/send_invites", "Email invites to all loaded users"),
         ("/team_info", "Show loaded team data"),
+        ("/find <query>", "Look up a participant by email or name"),
         ("/invite_info", "Show active invite links and usage"),
+        ("/resend_failed", "Retry only the invite emails that failed"),
+        ("/claim <code>", "Join your team with the claim code from your invite email"),
+        ("/jobs", "List background jobs and their progress"),
+        ("/cancel <job_id>", "Cancel a queued or running background job"),
+        ("/stats", "Show command latency, API calls and rate limit waits"),
+        ("/teardown [confirm]", "Preview, then delete everything created for the event"),
         ("/help_arc", "Show this help message")
     ]
     
@@ -730,9 +3216,10 @@ async def help_command(ctx):
 # ----------------------------
 # BOT EXECUTION
 # ----------------------------
-try:
-    bot.run(os.getenv('DISCORD_TOKEN'))
-except discord.LoginFailure:
-    print("Invalid Discord token. Check your .env file")
-except Exception as e:
-    print(f"Unexpected error: {str(e)}")
+if __name__ == "__main__":
+    try:
+        bot.run(os.getenv('DISCORD_TOKEN'))
+    except discord.LoginFailure:
+        log.error("Invalid Discord token. Check your .env file")
+    except Exception as e:
+        log.error(f"Unexpected error: {str(e)}")